@@ -1,13 +1,26 @@
 import os
-from flask import Flask, jsonify
+from flask import Flask
 from .models.models import setup_db
 from .auth.auth import AuthError
+from .cache import response_cache
+from .serializer import serializer, jsonify
+from .compression import compression
+from .timing import timing
+from .profiling import profiler, memory_tracer
+from . import metrics
 from flask_cors import CORS
 
 
 def create_app():
     app = Flask(__name__)
     setup_db(app)
+    timing.init_app(app)
+    response_cache.init_app(app)
+    serializer.init_app(app)
+    compression.init_app(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    memory_tracer.init_app(app)
     from .routes.routes import routes_blueprint
 
     @app.after_request
@@ -18,6 +31,8 @@ def create_app():
         response.headers.add(
             "Access-Control-Allow-Methods", "GET,PUT,POST,PATCH,DELETE,OPTIONS"
         )
+        response.headers.add("Access-Control-Expose-Headers",
+                             "X-Total-Count,ETag,Server-Timing")
         return response
 
     app.register_blueprint(routes_blueprint, url_prefix="/api")
@@ -56,6 +71,27 @@ def create_app():
         message = {"success": False, "error": 401, "message": "unauthorized"}
         return jsonify(message), 401
 
+    @app.errorhandler(410)
+    def gone(error):
+        message = {"success": False, "error": 410, "message": "gone"}
+        return jsonify(message), 410
+
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        message = {
+            "success": False,
+            "error": 412,
+            "message": "precondition failed"}
+        return jsonify(message), 412
+
+    @app.errorhandler(413)
+    def too_large(error):
+        message = {
+            "success": False,
+            "error": 413,
+            "message": "request entity too large"}
+        return jsonify(message), 413
+
     @app.errorhandler(AuthError)
     def handle_auth_errors(ex):
         response = jsonify(ex.error)
@@ -1,14 +1,39 @@
 import os
-import json
 from flask import request, _request_ctx_stack, abort
+from collections import namedtuple
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+from .cache import JWKSCache, JWKSUnavailable, TokenCache
+from ..timing import phase
+from ..profiling import profiler, PROFILE_HEADER
 
 
 AUTH0_DOMAIN = os.environ["AUTH0_DOMAIN"]
 ALGORITHMS = [os.environ["ALGORITHMS"]]
 API_AUDIENCE = os.environ["API_AUDIENCE"]
+JWKS_URL = os.environ.get(
+    "JWKS_URL", f"https://{AUTH0_DOMAIN}/.well-known/jwks.json"
+)
+
+"""
+Signing keys are shared by every request that goes through requires_auth,
+see JWKSCache for the refresh policy
+"""
+jwks_cache = JWKSCache(
+    JWKS_URL,
+    ttl=int(os.environ.get("JWKS_CACHE_TTL", 3600)),
+    stale_ttl=int(os.environ.get("JWKS_STALE_TTL", 86400)),
+    min_refresh_interval=int(os.environ.get("JWKS_MIN_REFRESH_INTERVAL", 30)),
+)
+
+"""
+Payloads of verified tokens, so a token seen before skips RS256 verification
+until it expires
+"""
+token_cache = TokenCache(
+    maxsize=int(os.environ.get("TOKEN_CACHE_SIZE", 1024)),
+    max_ttl=int(os.environ.get("TOKEN_CACHE_MAX_TTL", 3600)),
+)
 
 # AuthError Exception
 """
@@ -74,32 +99,76 @@ def get_token_auth_header():
     return token
 
 
-def check_permissions(permission, payload):
+"""
+Required permissions are compiled once, when requires_auth is applied, and
+granted permissions once per token, so a check is a couple of set operations
+"""
+
+MISSING_PERMISSIONS = {
+    "code": "invalid_claims",
+    "description": "Permissions not included in JWT.",
+    "success": False,
+}
+
+PERMISSION_NOT_FOUND = {
+    "code": "unauthorized",
+    "description": "Permission not found.",
+    "success": False,
+}
+
+Requirement = namedtuple("Requirement", ["all_of", "any_of"])
+
+
+def compile_permissions(permission="", any_of=None):
+    """Builds a Requirement from a permission or an iterable of permissions
+    that are all required, and an optional iterable of which one is enough
+    """
+    if isinstance(permission, Requirement):
+        return permission
+    if isinstance(permission, str):
+        permission = [permission] if permission else []
+    return Requirement(frozenset(permission), frozenset(any_of or ()))
+
+
+def permission_set(payload):
+    """Returns the permissions claim of payload as a frozenset, or None"""
     if "permissions" not in payload:
-        raise AuthError(
-            {
-                "code": "invalid_claims",
-                "description": "Permissions not included in JWT.",
-                "success": False,
-            },
-            400,
-        )
+        return None
+    return frozenset(payload["permissions"])
 
-    if permission not in payload["permissions"]:
-        raise AuthError(
-            {
-                "code": "unauthorized",
-                "description": "Permission not found.",
-                "success": False,
-            },
-            401,
-        )
+
+def authorize(required, granted):
+    """Checks a compiled Requirement against a set of granted permissions"""
+    if granted is None:
+        raise AuthError(MISSING_PERMISSIONS, 400)
+    if not required.all_of <= granted or (
+        required.any_of and required.any_of.isdisjoint(granted)
+    ):
+        raise AuthError(PERMISSION_NOT_FOUND, 401)
     return True
 
 
+def check_permissions(permission, payload):
+    return authorize(compile_permissions(permission), permission_set(payload))
+
+
+def verify_token(token):
+    """Returns the verified payload of token along with its permission set,
+    both are cached until the token expires
+    """
+    entry = token_cache.get(token)
+    if entry is None:
+        payload = decode_jwt(token)
+        entry = (payload, permission_set(payload))
+        token_cache.put(token, entry, payload.get("exp"))
+    return entry
+
+
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f"https://{AUTH0_DOMAIN}/.well-known/jwks.json")
-    jwks = json.loads(jsonurl.read())
+    return verify_token(token)[0]
+
+
+def decode_jwt(token):
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
     if "kid" not in unverified_header:
@@ -112,15 +181,26 @@ def verify_decode_jwt(token):
             401,
         )
 
-    for key in jwks["keys"]:
-        if key["kid"] == unverified_header["kid"]:
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"],
-            }
+    try:
+        with phase("jwks"):
+            key = jwks_cache.get_key(unverified_header["kid"])
+    except JWKSUnavailable:
+        raise AuthError(
+            {
+                "code": "jwks_unavailable",
+                "description": "Unable to fetch the signing keys.",
+                "success": False,
+            },
+            503,
+        )
+    if key is not None:
+        rsa_key = {
+            "kty": key["kty"],
+            "kid": key["kid"],
+            "use": key["use"],
+            "n": key["n"],
+            "e": key["e"],
+        }
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -172,16 +252,33 @@ def verify_decode_jwt(token):
     )
 
 
-def requires_auth(permission=""):
+PROFILE_PERMISSION = compile_permissions("admin:profile")
+
+
+def requires_auth(permission="", any_of=None):
+    """permission may be a single permission or an iterable of permissions
+    that are all required, any_of an iterable of which one is enough.
+
+    Requests sent with the X-Profile header run under the profiler, their
+    token also needs admin:profile.
+    """
+    required = compile_permissions(permission, any_of)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            try:
-                token = get_token_auth_header()
-            except:
-                abort(401)
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with phase("auth"):
+                try:
+                    token = get_token_auth_header()
+                except:
+                    abort(401)
+                payload, granted = verify_token(token)
+                authorize(required, granted)
+                profile = PROFILE_HEADER in request.headers
+                if profile:
+                    authorize(PROFILE_PERMISSION, granted)
+            if profile:
+                return profiler.run(f, payload, *args, **kwargs)
             return f(payload, *args, **kwargs)
 
         return wrapper
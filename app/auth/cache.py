@@ -0,0 +1,216 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from urllib.request import urlopen
+
+logger = logging.getLogger(__name__)
+
+
+class JWKSUnavailable(Exception):
+    """Raised when no usable copy of the JWKS can be obtained"""
+
+
+class JWKSCache:
+    """Keeps the signing keys of a JWKS document in memory.
+
+    Keys older than ``refresh_after`` seconds are re-fetched in a background
+    thread while the cached copy keeps being served, expired keys (older
+    than ``ttl``) included, until they are ``stale_ttl`` seconds old. Only
+    without keys or with keys past ``stale_ttl`` does a request wait for a
+    fetch. A token carrying an unknown ``kid`` forces a refresh. Fetches
+    that can be avoided are attempted at most once every
+    ``min_refresh_interval`` seconds, so bogus tokens or an outage of the
+    identity provider don't turn into a fetch per request.
+
+    Fetches are serialized, and whether one is still needed is checked
+    again once the lock is held: requests that waited for a fetch use its
+    result instead of fetching again.
+
+    ``url`` may be any URL understood by ``urlopen``, so a local
+    ``file://`` JWKS works as well.
+    """
+
+    def __init__(
+        self,
+        url,
+        ttl=3600,
+        refresh_after=None,
+        stale_ttl=86400,
+        min_refresh_interval=30,
+        timeout=5,
+    ):
+        self.url = url
+        self.ttl = ttl
+        self.refresh_after = (ttl * 0.8 if refresh_after is None
+                              else refresh_after)
+        self.stale_ttl = max(stale_ttl, ttl)
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._fetch_lock = threading.Lock()
+        self._background = None
+
+    def _fetch(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            jwks = json.loads(response.read())
+        return {key["kid"]: key for key in jwks["keys"]}
+
+    def _age(self, now):
+        if self._fetched_at is None:
+            return None
+        return now - self._fetched_at
+
+    def _may_attempt(self, now):
+        return (
+            self._last_attempt is None
+            or now - self._last_attempt >= self.min_refresh_interval
+        )
+
+    def refresh(self):
+        """Fetches the JWKS now, returns True if the keys were replaced"""
+        with self._fetch_lock:
+            return self._refresh()
+
+    def _refresh(self):
+        # called with _fetch_lock held
+        self._last_attempt = time.monotonic()
+        try:
+            keys = self._fetch()
+        except Exception:
+            logger.warning("Unable to fetch JWKS from %s", self.url,
+                           exc_info=True)
+            return False
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+        return True
+
+    def _refresh_if(self, needed):
+        """Fetches the JWKS if needed() still holds once the lock is taken,
+        and no fetch was attempted in the last min_refresh_interval seconds
+        """
+        with self._fetch_lock:
+            if needed() and self._may_attempt(time.monotonic()):
+                self._refresh()
+
+    def _refresh_in_background(self):
+        if self._background is not None and self._background.is_alive():
+            return
+        # The thread is started lazily so it never has to survive a fork
+        # of a gunicorn worker.
+        self._background = threading.Thread(
+            target=self._refresh_if, args=(self._needs_refresh,),
+            name="jwks-refresh", daemon=True
+        )
+        self._background.start()
+
+    def _needs_refresh(self):
+        age = self._age(time.monotonic())
+        return age is None or age >= self.refresh_after
+
+    def _unusable(self):
+        age = self._age(time.monotonic())
+        return age is None or age >= self.stale_ttl
+
+    def _ensure_fresh(self):
+        now = time.monotonic()
+        age = self._age(now)
+        if age is not None and age < self.refresh_after:
+            return
+        if age is not None and age < self.stale_ttl:
+            if self._may_attempt(now):
+                self._refresh_in_background()
+            return
+        self._refresh_if(self._unusable)
+        if self._unusable():
+            raise JWKSUnavailable(self.url)
+
+    def get_key(self, kid):
+        """Returns the JWK with the given kid, or None if it doesn't exist"""
+        self._ensure_fresh()
+        key = self._keys.get(kid)
+        if key is None:
+            self._refresh_if(lambda: kid not in self._keys)
+            key = self._keys.get(kid)
+        return key
+
+    def clear(self):
+        """Forgets the cached keys"""
+        with self._fetch_lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+
+
+class TokenCache:
+    """Bounded LRU cache of already verified bearer tokens.
+
+    Entries are keyed by the SHA-256 digest of the token, so raw tokens are
+    never kept around, and live until the token expires or ``max_ttl``
+    seconds have passed, whichever comes first. Once ``maxsize`` entries are
+    stored the least recently used one is evicted. A ``maxsize`` of 0
+    disables the cache.
+    """
+
+    def __init__(self, maxsize=1024, max_ttl=3600):
+        self.maxsize = maxsize
+        self.max_ttl = max_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        """Returns the value stored for token, or None"""
+        key = self._digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, token, value, expires_at=None):
+        """Stores value for token until expires_at (a unix timestamp)"""
+        if self.maxsize <= 0:
+            return
+        deadline = time.time() + self.max_ttl
+        if expires_at is not None:
+            deadline = min(deadline, expires_at)
+        key = self._digest(token)
+        with self._lock:
+            self._entries[key] = (deadline, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Drops every entry and resets the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Returns the size of the cache and its hit/miss counters"""
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
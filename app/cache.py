@@ -0,0 +1,203 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import request, make_response, Response
+
+logger = logging.getLogger(__name__)
+
+"""
+Response cache for the read endpoints
+
+Entries are keyed by resource, route and query string. Every resource has a
+generation number that is part of the key, invalidating a resource bumps
+its generation so all of its entries become unreachable at once while the
+other resources keep theirs. Unreachable entries age out of the backend.
+"""
+
+
+class LRUBackend:
+    """In-process backend, each worker keeps its own entries"""
+
+    def __init__(self, maxsize=512, ttl=10):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def generation(self, namespace):
+        return self._generations.get(namespace, 0)
+
+    def bump(self, namespace):
+        with self._lock:
+            self._generations[namespace] = self.generation(namespace) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+
+
+class RedisBackend:
+    """Backend shared by every worker, for Redis or any server speaking its
+    protocol. Needs the optional redis package.
+    """
+
+    def __init__(self, url, ttl=10, prefix="casting:cache:"):
+        import redis
+
+        self.ttl = ttl
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            return None
+        etag, mimetype, body = raw.split(b"\n", 2)
+        return body, mimetype.decode(), etag.decode()
+
+    def set(self, key, value):
+        body, mimetype, etag = value
+        raw = b"\n".join([etag.encode(), mimetype.encode(), body])
+        self.client.setex(self.prefix + key, self.ttl, raw)
+
+    def generation(self, namespace):
+        value = self.client.get(self.prefix + "generation:" + namespace)
+        return int(value or 0)
+
+    def bump(self, namespace):
+        self.client.incr(self.prefix + "generation:" + namespace)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+class ResponseCache:
+    def __init__(self):
+        self.backend = None
+
+    def init_app(self, app):
+        """Picks the backend from RESPONSE_CACHE: lru (default), redis or
+        none
+        """
+        kind = os.environ.get("RESPONSE_CACHE", "lru")
+        ttl = int(os.environ.get("RESPONSE_CACHE_TTL", 10))
+        if kind == "lru":
+            size = int(os.environ.get("RESPONSE_CACHE_SIZE", 512))
+            self.backend = LRUBackend(maxsize=size, ttl=ttl)
+        elif kind == "redis":
+            url = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+            self.backend = RedisBackend(url, ttl=ttl)
+        elif kind == "none":
+            self.backend = None
+        else:
+            raise ValueError(f"Unknown RESPONSE_CACHE backend {kind}")
+        app.extensions["response_cache"] = self
+
+    def _call(self, method, *args):
+        """Runs a backend method, a failing backend is treated as a miss"""
+        try:
+            return getattr(self.backend, method)(*args)
+        except Exception:
+            logger.warning("Response cache %s failed", method, exc_info=True)
+            return None
+
+    def _key(self, resource):
+        generation = self._call("generation", resource) or 0
+        query = "&".join(sorted(request.query_string.decode().split("&")))
+        raw = f"{request.path}?{query}".encode()
+        return f"{resource}:{generation}:{hashlib.sha1(raw).hexdigest()}"
+
+    def invalidate(self, *resources):
+        if self.backend is None:
+            return
+        for resource in resources:
+            self._call("bump", resource)
+
+    def clear(self):
+        if self.backend is not None:
+            self._call("clear")
+
+    def cached(self, resource):
+        """Caches successful GET responses of the decorated view under
+        resource and answers If-None-Match with a 304
+        """
+
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if request.method != "GET":
+                    return f(*args, **kwargs)
+                key = None
+                if self.backend is not None:
+                    key = self._key(resource)
+                    value = self._call("get", key)
+                    if value is not None:
+                        return cached_response(*value)
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                body = response.get_data()
+                etag = response.get_etag()[0]
+                if etag is None:
+                    etag = hashlib.sha1(body).hexdigest()
+                    response.set_etag(etag)
+                if key is not None:
+                    self._call("set", key, (body, response.mimetype, etag))
+                return response.make_conditional(request)
+
+            return wrapper
+
+        return decorator
+
+    def invalidates(self, *resources):
+        """Invalidates resources once the decorated view has run"""
+
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.invalidate(*resources)
+
+            return wrapper
+
+        return decorator
+
+
+def cached_response(body, mimetype, etag):
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    return response
+
+
+response_cache = ResponseCache()
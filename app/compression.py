@@ -0,0 +1,149 @@
+import os
+import gzip
+import json
+import zlib
+from io import BytesIO
+from flask import request
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import get_input_stream
+from .timing import phase
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+"""
+Response compression, and decompression of gzip request bodies
+
+Responses are compressed with brotli (when the brotli package is installed)
+or gzip, whichever the client prefers in Accept-Encoding. Small bodies,
+streamed responses, responses that already have a Content-Encoding and
+types that don't compress well are sent as they are.
+"""
+
+COMPRESSIBLE_MIMETYPES = {
+    "application/json",
+    "application/x-ndjson",
+    "text/html",
+    "text/plain",
+    "text/css",
+    "application/javascript",
+}
+
+
+class Compression:
+    def init_app(self, app):
+        """Reads COMPRESS_MIN_SIZE, COMPRESS_LEVEL, COMPRESS_BROTLI_LEVEL
+        and MAX_DECOMPRESSED_SIZE, a COMPRESS_LEVEL of 0 turns compression
+        of the responses off
+        """
+        self.min_size = int(os.environ.get("COMPRESS_MIN_SIZE", 500))
+        self.level = int(os.environ.get("COMPRESS_LEVEL", 6))
+        self.brotli_level = int(os.environ.get("COMPRESS_BROTLI_LEVEL", 4))
+        self.encodings = ["br", "gzip"] if brotli is not None else ["gzip"]
+        max_size = int(os.environ.get("MAX_DECOMPRESSED_SIZE",
+                                      10 * 1024 * 1024))
+        app.wsgi_app = GzipRequestMiddleware(app.wsgi_app, max_size)
+        if self.level > 0:
+            app.after_request(self.compress)
+        app.extensions["compression"] = self
+
+    def encoding(self):
+        """The encoding preferred by the client, None for identity"""
+        return request.accept_encodings.best_match(self.encodings)
+
+    def compress(self, response):
+        if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return response
+        response.vary.add("Accept-Encoding")
+        if response.status_code == 304:
+            # keeps the etag the same as on the compressed 200
+            if self.encoding() is not None:
+                weaken_etag(response)
+            return response
+        if (response.status_code < 200 or response.status_code == 204
+                or response.is_streamed or response.direct_passthrough
+                or "Content-Encoding" in response.headers):
+            return response
+        body = response.get_data()
+        if len(body) < self.min_size:
+            return response
+        encoding = self.encoding()
+        if encoding is None:
+            return response
+        with phase("compress"):
+            if encoding == "br":
+                body = brotli.compress(body, quality=self.brotli_level)
+            else:
+                body = gzip.compress(body, compresslevel=self.level, mtime=0)
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+        weaken_etag(response)
+        return response
+
+
+def weaken_etag(response):
+    """The compressed bytes differ from the ones the etag was computed on,
+    but they represent the same content
+    """
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+
+class GzipRequestMiddleware:
+    """Decompresses request bodies sent with Content-Encoding: gzip before
+    the app reads them. Bodies growing past max_size once decompressed are
+    rejected with a 413, so a small compressed payload can't exhaust the
+    memory of the worker.
+    """
+
+    def __init__(self, wsgi_app, max_size):
+        self.wsgi_app = wsgi_app
+        self.max_size = max_size
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get("HTTP_CONTENT_ENCODING", "").strip().lower()
+        if encoding in ("", "identity"):
+            return self.wsgi_app(environ, start_response)
+        if encoding != "gzip":
+            return error(415, "unsupported media type")(
+                environ, start_response)
+
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        stream = get_input_stream(environ)
+        chunks = []
+        size = 0
+        try:
+            while not decompressor.eof:
+                chunk = stream.read(64 * 1024)
+                if not chunk:
+                    break
+                data = decompressor.decompress(chunk,
+                                               self.max_size + 1 - size)
+                size += len(data)
+                if size > self.max_size:
+                    return error(413, "request entity too large")(
+                        environ, start_response)
+                chunks.append(data)
+        except zlib.error:
+            return error(400, "bad request")(environ, start_response)
+        if not decompressor.eof:
+            return error(400, "bad request")(environ, start_response)
+
+        body = b"".join(chunks)
+        environ["wsgi.input"] = BytesIO(body)
+        environ["CONTENT_LENGTH"] = str(len(body))
+        environ.pop("HTTP_CONTENT_ENCODING")
+        return self.wsgi_app(environ, start_response)
+
+
+def error(status, message):
+    """Same body as the error handlers of the app"""
+    body = json.dumps({"error": status, "message": message,
+                       "success": False}, separators=(",", ":"))
+    return Response(body + "\n", status=status, mimetype="application/json")
+
+
+compression = Compression()
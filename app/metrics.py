@@ -0,0 +1,146 @@
+import os
+import hmac
+import threading
+from bisect import bisect_left
+from flask import Response, request, abort
+
+"""
+Minimal Prometheus instrumentation, rendered in the text exposition format
+on /metrics. Every gunicorn worker keeps its own registry, so a scrape
+reflects the worker that answered it.
+
+/metrics is only served when METRICS_TOKEN is set, to scrapers sending it
+as a bearer token.
+"""
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+                         .replace('"', '\\"'))
+        for name, value in pairs) + "}"
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        # counts[i] holds the observations that fall in bucket i only, they
+        # are made cumulative when rendered
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self):
+        with self._lock:
+            series = [(k, list(v[0]), v[1]) for k, v in self._series.items()]
+        for labelvalues, counts, total in series:
+            cumulative = 0
+            bounds = [str(b) for b in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                labels = _labels(self.labelnames, labelvalues,
+                                 [("le", bound)])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _labels(self.labelnames, labelvalues)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            value = self._values.get(labelvalues, 0)
+            self._values[labelvalues] = value + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for labelvalues, value in values:
+            yield f"{self.name}{_labels(self.labelnames, labelvalues)} {value}"
+
+
+class Gauge:
+    """A value read from a callback when the metrics are rendered, the
+    callback returns None when there is nothing to report
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, help, callback):
+        self.name = name
+        self.help = help
+        self.callback = callback
+
+    def samples(self):
+        value = self.callback()
+        if value is not None:
+            yield f"{self.name} {value}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        """Adds metric, or returns the one already registered by that name"""
+        return self._metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            samples = list(metric.samples())
+            if not samples:
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def init_app(app):
+    """Serves /metrics when METRICS_TOKEN is set"""
+    token = os.environ.get("METRICS_TOKEN")
+    if not token:
+        return
+    expected = f"Bearer {token}".encode()
+
+    def metrics():
+        given = request.headers.get("Authorization", "").encode()
+        if not hmac.compare_digest(given, expected):
+            abort(401)
+        return Response(registry.render(),
+                        mimetype="text/plain; version=0.0.4")
+
+    app.add_url_rule("/metrics", "metrics", metrics)
@@ -1,25 +1,46 @@
 import os
-import datetime
-from sqlalchemy import Column, String, create_engine
+import time
+from sqlalchemy import (Column, String, DateTime, create_engine, func, and_,
+                        select, bindparam, literal)
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.ext.compiler import compiles
 from flask_sqlalchemy import SQLAlchemy
 import json
+from .pool import (engine_options, register_pool_metrics,
+                   register_statement_timeout)
+from .queries import query_accounting
+from .search import install_search_ddl
 
 database_path = os.environ["DATABASE_URL"]
+DB_CREATE_ALL = os.environ.get("DB_CREATE_ALL", "0").lower() in ("1", "true")
+COUNT_CACHE_TTL = float(os.environ.get("COUNT_CACHE_TTL", 10))
 
-db = SQLAlchemy()
+# committed objects keep their loaded state, reading an attribute after
+# a commit (e.g. the id of a new row) doesn't trigger another SELECT
+db = SQLAlchemy(session_options={"expire_on_commit": False})
 
 """
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+
+The schema is owned by the Alembic migrations, so by default nothing is
+created or inspected at startup. Set DB_CREATE_ALL=1 (or pass
+create_all=True) to have missing tables created, e.g. for a throwaway
+development database.
 """
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, create_all=DB_CREATE_ALL):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
-    db.create_all()
+    register_pool_metrics(db)
+    register_statement_timeout(db.get_engine(app))
+    query_accounting.init_app(app, db.get_engine(app))
+    if create_all:
+        db.create_all()
 
 
 def db_drop_and_create_all():
@@ -30,6 +51,272 @@ def db_drop_and_create_all():
     db.create_all()
 
 
+class utc_now(FunctionElement):
+    """The current UTC time read from the database clock, so the rows
+    written by every app server are stamped by the same clock
+    """
+
+    type = DateTime()
+    name = "utc_now"
+
+
+@compiles(utc_now)
+def _utc_now(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(utc_now, "postgresql")
+def _utc_now_postgresql(element, compiler, **kw):
+    return "(now() at time zone 'utc')"
+
+
+@compiles(utc_now, "sqlite")
+def _utc_now_sqlite(element, compiler, **kw):
+    # in the format SQLAlchemy stores datetimes in, SQLite's clock only
+    # has milliseconds
+    return "strftime('%Y-%m-%d %H:%M:%f000', 'now')"
+
+
+"""
+Row counts are cached per model for COUNT_CACHE_TTL seconds and dropped
+whenever a row is inserted or deleted through this process. Other workers
+pick up the change once their own copy expires.
+"""
+
+_counts = {}
+
+
+def count_rows(model, conditions=None):
+    """Returns SELECT count(*) of the model's table, cached. Counts
+    restricted by conditions are not cached.
+    """
+    if conditions:
+        query = db.session.query(func.count(model.id)).filter(*conditions)
+        return query.scalar()
+    cached = _counts.get(model.__tablename__)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    count = db.session.query(func.count(model.id)).scalar()
+    _counts[model.__tablename__] = (time.monotonic() + COUNT_CACHE_TTL, count)
+    return count
+
+
+def invalidate_count(model):
+    _counts.pop(model.__tablename__, None)
+
+
+"""
+Bulk helpers, each one runs in a single transaction and works on plain
+column dicts so no ORM objects are built for the rows. Id lists are sent
+in chunks of BULK_CHUNK_SIZE to stay under the bind parameter limits.
+"""
+
+BULK_CHUNK_SIZE = 500
+
+
+def _chunks(items, size=BULK_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def supports_returning():
+    """True if the database can return rows from INSERT/UPDATE/DELETE"""
+    return db.engine.dialect.name == "postgresql"
+
+
+def bulk_insert(model, rows):
+    """Inserts a list of column dicts, returns the new ids in order"""
+    table = model.__table__
+    try:
+        if supports_returning():
+            ids = []
+            for chunk in _chunks(rows):
+                result = db.session.execute(
+                    table.insert().values(chunk).returning(table.c.id))
+                ids.extend(row[0] for row in result)
+        else:
+            rows = [dict(row) for row in rows]
+            db.session.bulk_insert_mappings(model, rows, return_defaults=True)
+            ids = [row["id"] for row in rows]
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    invalidate_count(model)
+    return ids
+
+
+def existing_ids(model, ids):
+    """Returns the subset of ids that exist in the model's table"""
+    found = set()
+    with query_accounting.chunked():
+        for chunk in _chunks(list(ids)):
+            rows = db.session.query(model.id).filter(model.id.in_(chunk))
+            found.update(row[0] for row in rows)
+    return found
+
+
+def bulk_update(model, rows):
+    """Applies a list of column dicts that include the id, rows whose id
+    doesn't exist are skipped and the version of the others is bumped.
+    Returns the set of updated ids.
+    """
+    table = model.__table__
+    # one executemany per set of updated columns
+    groups = {}
+    for row in rows:
+        keys = tuple(sorted(key for key in row if key != "id"))
+        groups.setdefault(keys, []).append(row)
+    try:
+        found = existing_ids(model, [row["id"] for row in rows])
+        for keys, group in groups.items():
+            statement = table.update().where(
+                table.c.id == bindparam("_id")).values(
+                    {key: bindparam("_" + key) for key in keys},
+                    version=table.c.version + 1)
+            params = [{"_" + key: value for key, value in row.items()}
+                      for row in group if row["id"] in found]
+            if params:
+                db.session.execute(statement, params)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return found
+
+
+def insert_row(model, values):
+    """Inserts one row from a column dict and returns its id, read back
+    from the INSERT itself (RETURNING on Postgres, the cursor's lastrowid
+    elsewhere) rather than by a SELECT
+    """
+    table = model.__table__
+    try:
+        result = db.session.execute(table.insert().values(**values))
+        id = result.inserted_primary_key[0]
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    invalidate_count(model)
+    return id
+
+
+def delete_rows(model, ids):
+    """Deletes rows by id without loading them, with one DELETE per chunk
+    of ids. Returns the number of rows deleted.
+    """
+    ids = list(set(ids))
+    deleted = 0
+    try:
+        for chunk in _chunks(ids):
+            deleted += _delete(model, chunk).rowcount
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if deleted:
+        invalidate_count(model)
+    return deleted
+
+
+def update_row(model, id, values, versions=None):
+    """Updates the row with the given id in a single statement and bumps
+    its version. When versions is given the row is only updated if its
+    version is one of them. Returns the id, new version and updated_at
+    of the row, None when no row matched.
+    """
+    table = model.__table__
+    condition = table.c.id == id
+    if versions is not None:
+        condition = and_(condition, table.c.version.in_(versions))
+    statement = table.update().where(condition).values(
+        version=table.c.version + 1, **values)
+    columns = [table.c.id, table.c.version, table.c.updated_at]
+    try:
+        if supports_returning():
+            row = db.session.execute(statement.returning(*columns)).first()
+        else:
+            row = None
+            if db.session.execute(statement).rowcount:
+                row = db.session.execute(
+                    select(columns).where(table.c.id == id)).first()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return row
+
+
+def _id_condition(table, ids):
+    if len(ids) == 1:
+        return table.c.id == ids[0]
+    return table.c.id.in_(ids)
+
+
+def _delete(model, ids):
+    """Deletes the rows with the given ids and writes a tombstone for each
+    deleted row. Returns the result of the last statement, its rowcount is
+    the number of deleted rows.
+
+    On Postgres this is a single statement: the DELETE runs in a CTE whose
+    RETURNING feeds the INSERT of the tombstones, which returns the deleted
+    ids. SQLite can't run a DELETE in a CTE, there an INSERT ... SELECT
+    writes the tombstones of the rows about to be deleted, then the DELETE
+    runs.
+    """
+    table = model.__table__
+    tombstones = Tombstone.__table__
+    columns = ["resource", "resource_id", "deleted_at"]
+    condition = _id_condition(table, ids)
+    if supports_returning():
+        deleted = table.delete().where(condition).returning(
+            table.c.id).cte("deleted")
+        rows = select([literal(model.__tablename__), deleted.c.id,
+                       utc_now()])
+        return db.session.execute(tombstones.insert().from_select(
+            columns, rows).returning(tombstones.c.resource_id))
+    rows = select([literal(model.__tablename__), table.c.id,
+                   utc_now()]).where(condition)
+    db.session.execute(tombstones.insert().from_select(columns, rows))
+    return db.session.execute(table.delete().where(condition))
+
+
+def prune_tombstones(before):
+    """Deletes the tombstones written before the given datetime, returns
+    how many were deleted
+    """
+    table = Tombstone.__table__
+    try:
+        pruned = db.session.execute(
+            table.delete().where(table.c.deleted_at < before)).rowcount
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return pruned
+
+
+def bulk_delete(model, ids):
+    """Deletes rows by id, returns the set of ids that were deleted"""
+    ids = list(set(ids))
+    try:
+        if supports_returning():
+            deleted = set()
+            for chunk in _chunks(ids):
+                deleted.update(row[0] for row in _delete(model, chunk))
+        else:
+            deleted = existing_ids(model, ids)
+            for chunk in _chunks(ids):
+                _delete(model, chunk)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    invalidate_count(model)
+    return deleted
+
+
 #############################################################
 # Models
 #############################################################
@@ -41,11 +328,25 @@ Actors
 
 class Actor(db.Model):
     __tablename__ = "actors"
+    __table_args__ = (
+        db.Index("ix_actors_gender_age", "gender", "age", "id"),
+        db.Index("ix_actors_age", "age", "id"),
+        db.Index("ix_actors_name", "name", "id"),
+        db.Index("ix_actors_updated_at", "updated_at", "id"),
+        db.Index("ix_actors_name_trgm", "name", postgresql_using="gin",
+                 postgresql_ops={"name": "gin_trgm_ops"}),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     age = db.Column(db.Integer, nullable=False)
     gender = db.Column(db.String(80), nullable=False)
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           server_default=utc_now(), onupdate=utc_now())
+
+    # ORM updates bump the version and check it hasn't moved meanwhile
+    __mapper_args__ = {"version_id_col": version}
 
     def __init__(self, name, age, gender):
         self.name = name
@@ -54,14 +355,19 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
+        db.session.flush()
         db.session.commit()
+        invalidate_count(type(self))
 
     def update(self):
         db.session.commit()
 
     def delete(self):
+        db.session.add(Tombstone(resource=self.__tablename__,
+                                 resource_id=self.id))
         db.session.delete(self)
         db.session.commit()
+        invalidate_count(type(self))
 
     def format(self):
         return {
@@ -79,10 +385,26 @@ Movie
 
 class Movie(db.Model):
     __tablename__ = "movies"
+    __table_args__ = (
+        db.Index("ix_movies_release_date", "release_date", "id"),
+        db.Index("ix_movies_title", "title", "id"),
+        db.Index("ix_movies_updated_at", "updated_at", "id"),
+        # lets Postgres answer LIKE 'prefix%' from an index whatever the
+        # collation of the database
+        db.Index("ix_movies_title_prefix", "title",
+                 postgresql_ops={"title": "varchar_pattern_ops"}),
+        db.Index("ix_movies_title_trgm", "title", postgresql_using="gin",
+                 postgresql_ops={"title": "gin_trgm_ops"}),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     release_date = db.Column(db.DateTime, nullable=False)
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           server_default=utc_now(), onupdate=utc_now())
+
+    __mapper_args__ = {"version_id_col": version}
 
     def __init__(self, title, release_date):
         self.title = title
@@ -90,17 +412,50 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
+        db.session.flush()
         db.session.commit()
+        invalidate_count(type(self))
 
     def update(self):
         db.session.commit()
 
     def delete(self):
+        db.session.add(Tombstone(resource=self.__tablename__,
+                                 resource_id=self.id))
         db.session.delete(self)
         db.session.commit()
+        invalidate_count(type(self))
 
     def format(self):
         return {
             "id": self.id,
             "title": self.title,
             "release_date": self.release_date}
+
+
+"""
+Tombstones
+"""
+
+
+class Tombstone(db.Model):
+    """Records the deletion of an actor or movie so the sync endpoints can
+    report it. Tombstones are kept until pruned with
+    manage.py prune_tombstones.
+    """
+
+    __tablename__ = "tombstones"
+    __table_args__ = (
+        db.Index("ix_tombstones_resource_deleted_at", "resource",
+                 "deleted_at", "id"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    resource = db.Column(db.String(20), nullable=False)
+    resource_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False,
+                           server_default=utc_now())
+
+
+install_search_ddl(Actor.__table__, "name")
+install_search_ddl(Movie.__table__, "title")
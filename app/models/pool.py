@@ -0,0 +1,98 @@
+import os
+import time
+from sqlalchemy import event
+from sqlalchemy.pool import NullPool, QueuePool
+from ..metrics import registry, Gauge, Histogram
+
+"""
+Engine and connection pool settings, read from the environment:
+
+DB_POOL_SIZE          connections kept open per worker (5)
+DB_MAX_OVERFLOW       extra connections opened under load (10)
+DB_POOL_TIMEOUT       seconds to wait for a free connection (30)
+DB_POOL_RECYCLE       seconds after which a connection is replaced (1800)
+DB_POOL_PRE_PING      test connections before handing them out (0)
+DB_STATEMENT_TIMEOUT  Postgres statement_timeout in milliseconds (unset)
+DB_NULLPOOL           open a connection per checkout, for pgbouncer (0)
+
+The statement_timeout is set with a SET on each new connection rather than
+as a startup parameter, which pgbouncer refuses.
+"""
+
+checkout_wait = registry.register(Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a connection from the pool",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0,
+             30.0),
+))
+
+
+def _flag(name):
+    return os.environ.get(name, "0").lower() in ("1", "true", "yes")
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            checkout_wait.observe(time.perf_counter() - start)
+
+
+def register_pool_metrics(db):
+    """Exposes the size and usage of db's pool as gauges"""
+
+    def stat(name):
+        def read():
+            method = getattr(db.engine.pool, name, None)
+            return None if method is None else method()
+
+        return read
+
+    registry.register(Gauge("db_pool_size", "Connections kept by the pool",
+                            stat("size")))
+    registry.register(Gauge("db_pool_checked_out",
+                            "Connections currently in use",
+                            stat("checkedout")))
+    registry.register(Gauge("db_pool_overflow",
+                            "Connections opened beyond the pool size",
+                            stat("overflow")))
+
+
+def engine_options(database_path):
+    """Returns the SQLALCHEMY_ENGINE_OPTIONS for database_path"""
+    options = {"pool_pre_ping": _flag("DB_POOL_PRE_PING")}
+    if database_path.startswith("sqlite"):
+        # sqlite picks its own pool class and ignores the sizing options
+        return options
+
+    if _flag("DB_NULLPOOL"):
+        options["poolclass"] = NullPool
+    else:
+        options.update({
+            "poolclass": TimedQueuePool,
+            "pool_size": int(os.environ.get("DB_POOL_SIZE", 5)),
+            "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+            "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", 30)),
+            "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        })
+    return options
+
+
+def register_statement_timeout(engine):
+    """Sets DB_STATEMENT_TIMEOUT on each connection engine opens"""
+    statement_timeout = os.environ.get("DB_STATEMENT_TIMEOUT")
+    if not statement_timeout or engine.dialect.name != "postgresql":
+        return
+    statement = f"SET statement_timeout = {int(statement_timeout)}"
+
+    @event.listens_for(engine, "connect")
+    def set_statement_timeout(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(statement)
+        cursor.close()
+        # committed, so the setting outlives the pool's rollbacks
+        dbapi_connection.commit()
@@ -0,0 +1,148 @@
+import os
+import time
+import logging
+from contextlib import contextmanager
+from flask import g, has_app_context
+from sqlalchemy import event
+from ..metrics import registry, Counter, Histogram
+from ..timing import current_route, record
+
+logger = logging.getLogger(__name__)
+
+"""
+Accounting of the SQL statements run by each request, read from the
+environment:
+
+DB_SLOW_QUERY_MS         statements slower than this are logged along with
+                         their route, 0 turns the log off (500)
+DB_N_PLUS_ONE            off, warn or raise when one request runs the same
+                         SELECT more than DB_N_PLUS_ONE_THRESHOLD times,
+                         the sign of a query run once per row of a result
+                         (warn in debug mode, off otherwise)
+DB_N_PLUS_ONE_THRESHOLD  (10)
+
+The statements, their time and the rows the driver reports are counted
+per request and recorded on /metrics, their time is the db phase of the
+Server-Timing header. SQLite doesn't report the rows of a SELECT, only of
+the statements that change rows.
+
+A lookup split in chunks of ids repeats the same SELECT once per chunk,
+it runs in query_accounting.chunked() to be left out of the N+1 detection.
+"""
+
+queries_per_request = registry.register(Histogram(
+    "db_queries_per_request",
+    "SQL statements run by each request",
+    labelnames=("route",),
+    buckets=(1, 2, 3, 5, 10, 20, 50, 100, 200),
+))
+
+rows_per_request = registry.register(Histogram(
+    "db_rows_per_request",
+    "Rows returned or changed by the SQL statements of each request",
+    labelnames=("route",),
+    buckets=(1, 10, 100, 1000, 10000, 100000),
+))
+
+slow_queries = registry.register(Counter(
+    "db_slow_queries_total",
+    "SQL statements slower than DB_SLOW_QUERY_MS",
+    labelnames=("route",),
+))
+
+
+class NPlusOneQueries(Exception):
+    pass
+
+
+class QueryStats:
+    __slots__ = ("count", "rows", "statements", "chunked")
+
+    def __init__(self):
+        self.count = 0
+        self.rows = 0
+        # executions of each statement, for the N+1 detection
+        self.statements = {}
+        # depth of the chunked() blocks being run
+        self.chunked = 0
+
+
+def _is_select(statement):
+    return statement.lstrip()[:6].upper() == "SELECT"
+
+
+class QueryAccounting:
+    def init_app(self, app, engine):
+        """Listens to the statements run on engine and to the requests of
+        app
+        """
+        self.slow = float(os.environ.get("DB_SLOW_QUERY_MS", 500)) / 1000
+        self.n_plus_one = os.environ.get(
+            "DB_N_PLUS_ONE", "warn" if app.debug else "off").lower()
+        if self.n_plus_one not in ("off", "warn", "raise"):
+            raise ValueError(f"Unknown DB_N_PLUS_ONE {self.n_plus_one}")
+        self.threshold = int(os.environ.get("DB_N_PLUS_ONE_THRESHOLD", 10))
+        event.listen(engine, "before_cursor_execute", self.before_execute)
+        event.listen(engine, "after_cursor_execute", self.after_execute)
+        app.before_request(self.start)
+        app.after_request(self.finish)
+
+    def start(self):
+        g.queries = QueryStats()
+
+    def finish(self, response):
+        stats = g.pop("queries", None)
+        if stats is not None:
+            route = current_route()
+            queries_per_request.observe(stats.count, route)
+            rows_per_request.observe(stats.rows, route)
+        return response
+
+    @contextmanager
+    def chunked(self):
+        """The statements run inside aren't counted by the N+1 detection"""
+        stats = g.get("queries") if has_app_context() else None
+        if stats is None:
+            yield
+            return
+        stats.chunked += 1
+        try:
+            yield
+        finally:
+            stats.chunked -= 1
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        stats = g.get("queries") if has_app_context() else None
+        # only reads count, a bulk write may run one INSERT per row
+        if (stats is not None and self.n_plus_one != "off"
+                and not stats.chunked and not executemany
+                and _is_select(statement)):
+            executions = stats.statements.get(statement, 0) + 1
+            stats.statements[statement] = executions
+            if executions == self.threshold + 1:
+                message = (f"{current_route()} ran this statement more than "
+                           f"{self.threshold} times: {statement}")
+                if self.n_plus_one == "raise":
+                    raise NPlusOneQueries(message)
+                logger.warning("N+1 queries: %s", message)
+        conn.info["query_start"] = time.perf_counter()
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        seconds = time.perf_counter() - conn.info["query_start"]
+        if self.slow and seconds >= self.slow:
+            route = current_route() or "-"
+            slow_queries.inc(route)
+            logger.warning("Slow query on %s (%.1f ms): %s", route,
+                           seconds * 1000, statement)
+        stats = g.get("queries") if has_app_context() else None
+        if stats is None:
+            return
+        record("db", seconds)
+        stats.count += 1
+        if cursor.rowcount > 0:
+            stats.rows += cursor.rowcount
+
+
+query_accounting = QueryAccounting()
@@ -0,0 +1,118 @@
+import re
+from sqlalchemy import DDL, event, text
+
+"""
+Name and title search
+
+On Postgres the searched column has a trigram GIN index (pg_trgm), matches
+are ranked by trigram similarity. On SQLite an FTS5 table mirrors the
+column and is kept in sync by triggers, so every insert, update and delete
+updates the index incrementally, matches are ranked by bm25. Any other
+database falls back to an unindexed LIKE.
+"""
+
+SQLITE_FTS = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(
+        {column}, content='{table}', content_rowid='id'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS {table}_fts_insert
+    AFTER INSERT ON {table} BEGIN
+        INSERT INTO {table}_fts(rowid, {column})
+        VALUES (new.id, new.{column});
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS {table}_fts_delete
+    AFTER DELETE ON {table} BEGIN
+        INSERT INTO {table}_fts({table}_fts, rowid, {column})
+        VALUES ('delete', old.id, old.{column});
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS {table}_fts_update
+    AFTER UPDATE OF {column} ON {table} BEGIN
+        INSERT INTO {table}_fts({table}_fts, rowid, {column})
+        VALUES ('delete', old.id, old.{column});
+        INSERT INTO {table}_fts(rowid, {column})
+        VALUES (new.id, new.{column});
+    END""",
+    "INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')",
+]
+
+SQLITE_FTS_DROP = [
+    "DROP TRIGGER IF EXISTS {table}_fts_update",
+    "DROP TRIGGER IF EXISTS {table}_fts_delete",
+    "DROP TRIGGER IF EXISTS {table}_fts_insert",
+    "DROP TABLE IF EXISTS {table}_fts",
+]
+
+
+def sqlite_fts_statements(table, column, drop=False):
+    """Returns the statements creating (or dropping) the FTS5 mirror of
+    table.column and its triggers
+    """
+    templates = SQLITE_FTS_DROP if drop else SQLITE_FTS
+    return [t.format(table=table, column=column) for t in templates]
+
+
+def install_search_ddl(table, column):
+    """Hooks the search structures of table.column into create_all and
+    drop_all. The Postgres trigram index itself is declared on the model.
+    """
+    event.listen(table, "before_create", DDL(
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+    ).execute_if(dialect="postgresql"))
+    for statement in sqlite_fts_statements(table.name, column):
+        event.listen(table, "after_create", DDL(
+            statement).execute_if(dialect="sqlite"))
+    for statement in sqlite_fts_statements(table.name, column, drop=True):
+        event.listen(table, "before_drop", DDL(
+            statement).execute_if(dialect="sqlite"))
+
+
+def _like_pattern(query):
+    escaped = (query.replace("\\", "\\\\").replace("%", "\\%")
+               .replace("_", "\\_"))
+    return f"%{escaped}%"
+
+
+def _fts_query(query):
+    # every word has to match as a prefix, quoting keeps FTS5 syntax out
+    words = re.findall(r"\w+", query)
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def search(session, table, column, query, limit):
+    """Returns up to limit (id, value, score) tuples of the rows of table
+    whose column matches query, best match first
+    """
+    query = query.lower()
+    dialect = session.get_bind().dialect.name
+    params = {"q": query, "limit": limit}
+    if dialect == "postgresql":
+        sql = f"""
+            SELECT id, {column}, similarity({column}, :q) AS score
+            FROM {table}
+            WHERE {column} % :q OR {column} ILIKE :pattern ESCAPE '\\'
+            ORDER BY score DESC, id
+            LIMIT :limit
+        """
+        params["pattern"] = _like_pattern(query)
+    elif dialect == "sqlite":
+        params["q"] = _fts_query(query)
+        if not params["q"]:
+            return []
+        sql = f"""
+            SELECT t.id, t.{column}, -bm25({table}_fts) AS score
+            FROM {table}_fts JOIN {table} AS t ON t.id = {table}_fts.rowid
+            WHERE {table}_fts MATCH :q
+            ORDER BY bm25({table}_fts), t.id
+            LIMIT :limit
+        """
+    else:
+        sql = f"""
+            SELECT id, {column}, 0 AS score
+            FROM {table}
+            WHERE lower({column}) LIKE :pattern ESCAPE '\\'
+            ORDER BY id
+            LIMIT :limit
+        """
+        params["pattern"] = _like_pattern(query)
+    rows = session.execute(text(sql), params)
+    return [(row[0], row[1], float(row[2])) for row in rows]
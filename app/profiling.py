@@ -0,0 +1,192 @@
+import os
+import time
+import uuid
+import pstats
+import marshal
+import cProfile
+import datetime
+import threading
+import tracemalloc
+from io import StringIO
+from collections import OrderedDict
+from flask import request, make_response
+
+"""
+On demand profiling of requests and memory snapshots of the worker
+
+A request sent with an X-Profile header by a token holding admin:profile
+runs its handler under cProfile. The stats are kept in memory (the last
+PROFILE_HISTORY ones) and written to PROFILE_DIR when it is set, the
+response carries their id in X-Profile-Id.
+
+Memory snapshots are taken with tracemalloc, which starts tracing with the
+first snapshot and keeps TRACEMALLOC_FRAMES frames of each allocation, so
+only the allocations made since then are seen. Tracing slows the worker
+down until it is stopped.
+
+Every gunicorn worker keeps its own profiles and snapshots, PROFILE_DIR
+lets any worker serve the profiles of the others.
+"""
+
+PROFILE_HEADER = "X-Profile"
+
+# the names pstats.Stats.sort_stats accepts
+SORT_KEYS = frozenset(pstats.Stats.sort_arg_dict_default)
+
+
+def _now():
+    return datetime.datetime.utcnow().isoformat() + "Z"
+
+
+class Profiler:
+    def __init__(self):
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Reads PROFILE_HISTORY and PROFILE_DIR"""
+        self.maxsize = int(os.environ.get("PROFILE_HISTORY", 20))
+        self.directory = os.environ.get("PROFILE_DIR")
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        app.extensions["profiler"] = self
+
+    def run(self, f, *args, **kwargs):
+        """Calls the view f under cProfile"""
+        profile = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            response = profile.runcall(f, *args, **kwargs)
+        finally:
+            id = self.save(profile, time.perf_counter() - started)
+        response = make_response(response)
+        response.headers["X-Profile-Id"] = id
+        return response
+
+    def save(self, profile, seconds):
+        profile.create_stats()
+        id = uuid.uuid4().hex
+        info = {"id": id, "method": request.method,
+                "path": request.full_path.rstrip("?"),
+                "duration_ms": round(seconds * 1000, 3),
+                "created_at": _now()}
+        if self.directory:
+            profile.dump_stats(os.path.join(self.directory, id + ".prof"))
+        with self._lock:
+            self._profiles[id] = (info, profile.stats)
+            while len(self._profiles) > self.maxsize:
+                self._profiles.popitem(last=False)
+        return id
+
+    def profiles(self):
+        """Metadata of the profiles kept in memory, latest first"""
+        with self._lock:
+            return [info for info, _ in reversed(self._profiles.values())]
+
+    def raw(self, id):
+        """The stats of profile id in the pstats file format, or None"""
+        with self._lock:
+            entry = self._profiles.get(id)
+        if entry is not None:
+            return marshal.dumps(entry[1])
+        if self.directory and id.isalnum():
+            path = os.path.join(self.directory, id + ".prof")
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    return f.read()
+        return None
+
+    def report(self, id, sort="cumulative", limit=30):
+        """pstats listing of the limit top functions of profile id"""
+        raw = self.raw(id)
+        if raw is None:
+            return None
+        stats = pstats.Stats(_Loaded(marshal.loads(raw)), stream=StringIO())
+        stats.sort_stats(sort).print_stats(limit)
+        return stats.stream.getvalue()
+
+
+class _Loaded:
+    """Stats in the shape pstats.Stats loads them from a profiler"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class MemoryTracer:
+    def __init__(self):
+        self._snapshots = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_id = 1
+
+    def init_app(self, app):
+        """Reads TRACEMALLOC_FRAMES and TRACEMALLOC_SNAPSHOTS"""
+        self.frames = int(os.environ.get("TRACEMALLOC_FRAMES", 1))
+        self.maxsize = int(os.environ.get("TRACEMALLOC_SNAPSHOTS", 5))
+        app.extensions["memory_tracer"] = self
+
+    def snapshot(self):
+        """Takes a snapshot, returns its id"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+        with self._lock:
+            id = self._next_id
+            self._next_id += 1
+            self._snapshots[id] = (_now(), snapshot)
+            while len(self._snapshots) > self.maxsize:
+                self._snapshots.popitem(last=False)
+        return id
+
+    def get(self, id):
+        with self._lock:
+            return self._snapshots.get(id)
+
+    def snapshots(self):
+        with self._lock:
+            return [{"id": id, "created_at": created_at}
+                    for id, (created_at, _) in self._snapshots.items()]
+
+    def statistics(self, id, key="lineno", limit=20, compare=None):
+        """Top allocations of snapshot id grouped by key, or the largest
+        differences against snapshot compare. None if a snapshot is missing.
+        """
+        entry = self.get(id)
+        base = self.get(compare) if compare is not None else None
+        if entry is None or (compare is not None and base is None):
+            return None
+        snapshot = entry[1]
+        if base is None:
+            statistics = snapshot.statistics(key)
+        else:
+            statistics = snapshot.compare_to(base[1], key)
+        result = []
+        for stat in statistics[:limit]:
+            item = {"traceback": [str(frame) for frame in stat.traceback],
+                    "size": stat.size, "count": stat.count}
+            if base is not None:
+                item["size_diff"] = stat.size_diff
+                item["count_diff"] = stat.count_diff
+            result.append(item)
+        return result
+
+    def traced_memory(self):
+        current, peak = tracemalloc.get_traced_memory()
+        return {"tracing": tracemalloc.is_tracing(), "current": current,
+                "peak": peak}
+
+    def stop(self):
+        """Stops tracing and drops the snapshots"""
+        tracemalloc.stop()
+        with self._lock:
+            self._snapshots.clear()
+
+
+profiler = Profiler()
+memory_tracer = MemoryTracer()
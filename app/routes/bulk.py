@@ -0,0 +1,120 @@
+import os
+from flask import request, abort
+from ..models.models import bulk_insert, bulk_update, bulk_delete
+from ..serializer import jsonify
+from .validation import ValidationError, resource_id
+
+BULK_MAX_ITEMS = int(os.environ.get("BULK_MAX_ITEMS", 10000))
+
+"""
+Handlers behind the /<resource>/bulk endpoints. The whole payload is
+validated before anything is written and a single invalid item rejects the
+request with a 400. Valid payloads are written in one transaction and the
+response carries one result per item, in payload order.
+"""
+
+
+def bulk_items(key):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get(key), list):
+        abort(400)
+    items = data[key]
+    if len(items) == 0:
+        abort(400)
+    if len(items) > BULK_MAX_ITEMS:
+        abort(413)
+    return items
+
+
+def validate_items(items, validate):
+    """Returns the validated rows and the per item results, rows is None
+    if any item is invalid
+    """
+    rows = []
+    results = []
+    for index, item in enumerate(items):
+        try:
+            rows.append(validate(item))
+            results.append({"index": index, "success": True})
+        except ValidationError as e:
+            results.append(
+                {"index": index, "success": False, "message": e.message})
+    if len(rows) != len(items):
+        return None, results
+    return rows, results
+
+
+def invalid_payload(results):
+    response = {
+        "success": False,
+        "error": 400,
+        "message": "bad request",
+        "results": [r for r in results if not r["success"]],
+    }
+    return jsonify(response), 400
+
+
+def not_found(result):
+    result.update({"success": False, "error": 404,
+                   "message": "resource not found"})
+
+
+def create(model, key, validate):
+    rows, results = validate_items(bulk_items(key), validate)
+    if rows is None:
+        return invalid_payload(results)
+    try:
+        ids = bulk_insert(model, rows)
+    except Exception:
+        abort(422)
+    for result, id in zip(results, ids):
+        result["id"] = id
+    return jsonify({"success": True, "created": ids, "results": results})
+
+
+def update(model, key, validate):
+    seen = set()
+
+    def validate_item(item):
+        id = resource_id(item)
+        if id in seen:
+            raise ValidationError(f"id {id} is given more than once")
+        seen.add(id)
+        values = validate(item, partial=True)
+        values["id"] = id
+        return values
+
+    rows, results = validate_items(bulk_items(key), validate_item)
+    if rows is None:
+        return invalid_payload(results)
+    try:
+        updated = bulk_update(model, rows)
+    except Exception:
+        abort(422)
+    for result, row in zip(results, rows):
+        result["id"] = row["id"]
+        if row["id"] not in updated:
+            not_found(result)
+    updated = [row["id"] for row in rows if row["id"] in updated]
+    return jsonify({"success": True, "updated": updated, "results": results})
+
+
+def delete(model):
+    def validate_item(item):
+        if isinstance(item, bool) or not isinstance(item, int):
+            raise ValidationError("id must be an integer")
+        return item
+
+    ids, results = validate_items(bulk_items("ids"), validate_item)
+    if ids is None:
+        return invalid_payload(results)
+    try:
+        deleted = bulk_delete(model, ids)
+    except Exception:
+        abort(422)
+    for result, id in zip(results, ids):
+        result["id"] = id
+        if id not in deleted:
+            not_found(result)
+    deleted = [id for id in dict.fromkeys(ids) if id in deleted]
+    return jsonify({"success": True, "deleted": deleted, "results": results})
@@ -0,0 +1,112 @@
+from flask import request, abort
+from ..models.models import Actor, Movie
+from .validation import ValidationError, GENDERS, parse_release_date
+from .pagination import MAX_PAGE_SIZE
+
+"""
+Query string filters of the list endpoints. Each function returns the SQL
+conditions to apply, an empty list when no filter was given. Every filter
+is served by one of the indexes declared on the models.
+"""
+
+ACTOR_FIELDS = ["id", "name", "age", "gender"]
+MOVIE_FIELDS = ["id", "title", "release_date"]
+
+ACTOR_SORTS = {"id": Actor.id, "name": Actor.name, "age": Actor.age}
+MOVIE_SORTS = {
+    "id": Movie.id,
+    "title": Movie.title,
+    "release_date": Movie.release_date,
+}
+
+
+def fields_arg(allowed):
+    """Reads the comma separated fields to return, None when all of them
+    are wanted. Unknown fields are rejected with a 400.
+    """
+    value = request.args.get("fields")
+    if value is None:
+        return None
+    fields = [field.strip() for field in value.split(",") if field.strip()]
+    if not fields or any(field not in allowed for field in fields):
+        abort(400)
+    return list(dict.fromkeys(fields))
+
+
+def ids_arg():
+    """Reads the comma separated ids to look up, None when not given. At
+    most MAX_PAGE_SIZE ids are accepted.
+    """
+    value = request.args.get("ids")
+    if value is None:
+        return None
+    try:
+        ids = [int(id) for id in value.split(",") if id.strip()]
+    except ValueError:
+        abort(400)
+    if not ids or len(ids) > MAX_PAGE_SIZE:
+        abort(400)
+    return list(dict.fromkeys(ids))
+
+
+def select_columns(model, fields, *columns):
+    """Columns of model to select for the given fields, plus the given
+    columns, which the query needs for itself, and the primary key
+    """
+    names = dict.fromkeys(["id"] + list(fields) + [c.key for c in columns])
+    return [model.__table__.c[name] for name in names]
+
+
+def _int_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+
+def _date_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return parse_release_date(value)
+    except ValidationError:
+        abort(400)
+
+
+def actor_conditions():
+    """gender, min_age and max_age (both inclusive)"""
+    conditions = []
+    gender = request.args.get("gender")
+    if gender is not None:
+        if gender.lower() not in GENDERS:
+            abort(400)
+        conditions.append(Actor.gender == gender.lower())
+    min_age = _int_arg("min_age")
+    if min_age is not None:
+        conditions.append(Actor.age >= min_age)
+    max_age = _int_arg("max_age")
+    if max_age is not None:
+        conditions.append(Actor.age <= max_age)
+    return conditions
+
+
+def movie_conditions():
+    """title_prefix, released_after and released_before (both inclusive)"""
+    conditions = []
+    prefix = request.args.get("title_prefix")
+    if prefix:
+        # titles are stored in lower case
+        escaped = (prefix.lower().replace("\\", "\\\\")
+                   .replace("%", "\\%").replace("_", "\\_"))
+        conditions.append(Movie.title.like(escaped + "%", escape="\\"))
+    released_after = _date_arg("released_after")
+    if released_after is not None:
+        conditions.append(Movie.release_date >= released_after)
+    released_before = _date_arg("released_before")
+    if released_before is not None:
+        conditions.append(Movie.release_date <= released_before)
+    return conditions
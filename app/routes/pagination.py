@@ -0,0 +1,123 @@
+import os
+import json
+import base64
+import binascii
+import datetime
+from flask import request, abort
+from sqlalchemy import tuple_
+from ..models.models import db
+from ..timing import phase
+
+DEFAULT_PAGE_SIZE = int(os.environ.get("DEFAULT_PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 1000))
+
+"""
+Cursors are opaque to clients, they hold the sort key of the last row of a
+page encoded as urlsafe base64 json: [id] when sorting by id, and
+[value, id] when sorting by another column, id breaking ties.
+"""
+
+
+def encode_cursor(values):
+    values = [v.isoformat() if isinstance(v, datetime.datetime) else v
+              for v in values]
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def decode_cursor(cursor):
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        abort(400)
+    if not isinstance(values, list):
+        abort(400)
+    return values
+
+
+def page_args(cursor="after"):
+    """Reads limit and the cursor (after by default) from the query string,
+    the limit is capped at MAX_PAGE_SIZE
+    """
+    try:
+        limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    after = request.args.get(cursor)
+    if after is not None:
+        after = decode_cursor(after)
+    return limit, after
+
+
+def sort_arg(columns):
+    """Reads sort from the query string, a key of columns optionally
+    prefixed with - for descending order. Returns (column, descending).
+    """
+    sort = request.args.get("sort", "id")
+    descending = sort.startswith("-")
+    name = sort[1:] if descending else sort
+    if name not in columns:
+        abort(400)
+    return columns[name], descending
+
+
+def _cursor_value(column, value):
+    python_type = column.type.python_type
+    if python_type is datetime.datetime and isinstance(value, str):
+        try:
+            return datetime.datetime.fromisoformat(value)
+        except ValueError:
+            abort(400)
+    if not isinstance(value, python_type):
+        abort(400)
+    return value
+
+
+def keyset_page(query, columns, limit, after=None, descending=False):
+    """Returns up to limit rows of the select query ordered by columns,
+    starting after the given values of these columns, and whether more
+    rows follow
+    """
+    if after is not None:
+        if len(after) != len(columns):
+            abort(400)
+        values = [_cursor_value(c, v) for c, v in zip(columns, after)]
+        if len(columns) == 1:
+            key, values = columns[0], values[0]
+        else:
+            key = tuple_(*columns)
+            values = tuple_(*values)
+        query = query.where(key < values if descending else key > values)
+
+    order = [c.desc() if descending else c for c in columns]
+    result = db.session.execute(query.order_by(*order).limit(limit + 1))
+    with phase("format"):
+        rows = result.fetchall()
+    return rows[:limit], len(rows) > limit
+
+
+def paginate(query, id_column, limit, after, sort_column=None,
+             descending=False):
+    """Returns one page of the rows of the select query ordered by
+    sort_column then id, starting after the given cursor values, and the
+    cursor of the next page (None on the last page)
+
+    Only rows past the cursor are read, through an index on the sort
+    columns, and one extra row is fetched to know whether another page
+    exists.
+    """
+    if sort_column is None or sort_column is id_column:
+        columns = [id_column]
+    else:
+        columns = [sort_column, id_column]
+    rows, more = keyset_page(query, columns, limit, after, descending)
+    next_cursor = None
+    if more:
+        next_cursor = encode_cursor(
+            [getattr(rows[-1], c.key) for c in columns])
+    return rows, next_cursor
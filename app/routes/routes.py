@@ -1,11 +1,28 @@
 import os
-from flask import Blueprint, request, jsonify, abort, redirect, render_template
-from flask import json
-from ..models.models import Actor, Movie
-from ..auth.auth import requires_auth, AUTH0_DOMAIN, ALGORITHMS, API_AUDIENCE
+import hashlib
+from flask import Blueprint, request, abort, redirect, render_template
+from flask import Response, stream_with_context
+from sqlalchemy import select, and_
+from ..models.models import (Actor, Movie, db, count_rows, insert_row,
+                             update_row, delete_rows, existing_ids)
+from ..models.search import search
+from ..auth.auth import requires_auth, AUTH0_DOMAIN, API_AUDIENCE
+from ..cache import response_cache
+from ..timing import phase
+from ..profiling import profiler, memory_tracer, SORT_KEYS
+from ..serializer import jsonify, dumps
+from .pagination import page_args, paginate, sort_arg
+from .filters import (actor_conditions, movie_conditions, fields_arg,
+                      select_columns, ids_arg, ACTOR_SORTS, MOVIE_SORTS,
+                      ACTOR_FIELDS, MOVIE_FIELDS)
+from .validation import ValidationError, actor_values, movie_values
+from .sync import sync_changes
+from . import bulk
 
 CLIENT_ID = os.environ["CLIENT_ID"]
 CALLBACK_URL = os.environ["CALLBACK_URL"]
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 1000))
+SEARCH_MAX_RESULTS = int(os.environ.get("SEARCH_MAX_RESULTS", 100))
 routes_blueprint = Blueprint("routes_blueprint",
                              __name__,
                              template_folder="templates")
@@ -33,153 +50,486 @@ def get_token():
     return render_template("index.html")
 
 
-@routes_blueprint.route("/actors", methods=["GET"])
-@requires_auth(permission="get:actors")
-def show_actors(payload):
-    actors = Actor.query.all()
-    if len(actors) == 0:
+def count_response(model, conditions):
+    """Answers HEAD and count_only=1 requests with just the row count, HEAD
+    in an X-Total-Count header. Returns None for any other request.
+    """
+    if request.method == "HEAD":
+        response = Response(status=200, mimetype="application/json")
+        response.headers["X-Total-Count"] = str(
+            count_rows(model, conditions))
+        return response
+    if request.args.get("count_only") in ("1", "true"):
+        count = count_rows(model, conditions)
+        return jsonify({"success": True, "count": count})
+    return None
+
+
+def list_resources(model, key, conditions, sorts, fields):
+    """One page of the rows of model matching conditions, sorted by the
+    sort query parameter. Only the columns in the fields query parameter
+    are read and returned. With the ids query parameter the given rows are
+    returned instead, in the order of the ids, ids that don't exist are
+    listed under missing.
+
+    The total count of matching rows is only returned on the first page,
+    or with with_count=1.
+
+    Rows are read as plain tuples, without building ORM instances.
+    """
+    ids = ids_arg()
+    if ids is not None:
+        conditions = conditions + [model.id.in_(ids)]
+    response = count_response(model, conditions)
+    if response is not None:
+        return response
+    fields = fields_arg(fields) or fields
+    if ids is not None:
+        query = select(select_columns(model, fields)).where(
+            and_(*conditions))
+        result = db.session.execute(query)
+        with phase("format"):
+            found = {row.id: row for row in result}
+            rows = [{field: found[id][field] for field in fields}
+                    for id in ids if id in found]
+        if len(rows) == 0:
+            abort(404)
+        return jsonify({
+            "count": len(rows),
+            "success": True,
+            key: rows,
+            "missing": [id for id in ids if id not in found],
+        })
+
+    limit, after = page_args()
+    sort_column, descending = sort_arg(sorts)
+    query = select(select_columns(model, fields, sort_column))
+    if conditions:
+        query = query.where(and_(*conditions))
+    rows, next_cursor = paginate(query, model.id, limit, after, sort_column,
+                                 descending)
+    if len(rows) == 0:
         abort(404)
     else:
-        actors = [a.format() for a in actors]
-        response = {"count": len(actors), "success": True, "actors": actors}
+        with phase("format"):
+            rows = [{field: row[field] for field in fields} for row in rows]
+        response = {"success": True, key: rows, "next_cursor": next_cursor}
+        # the total doesn't change between pages, filtered counts aren't
+        # cached and would run again for every page
+        if after is None or request.args.get("with_count") in ("1", "true"):
+            response["count"] = count_rows(model, conditions)
         return jsonify(response)
 
 
+def resource_etag(model, row, fields):
+    """ETag of a row returned with the given fields. It holds the table, id
+    and version of the row, which If-Match checks, and a digest of its
+    updated_at and of the fields. updated_at tells apart two rows that got
+    the same id, SQLite reuses the id of a deleted last row.
+    """
+    digest = hashlib.sha1(
+        f"{row.updated_at.isoformat()}|{','.join(fields)}".encode()
+    ).hexdigest()[:16]
+    return f"{model.__tablename__}-{row.id}-{row.version}-{digest}"
+
+
+def show_resource(model, key, id, fields):
+    """One row of model, sent with its ETag"""
+    fields = fields_arg(fields) or fields
+    query = select(select_columns(model, fields, model.version,
+                                  model.updated_at)).where(model.id == id)
+    result = db.session.execute(query)
+    with phase("format"):
+        row = result.first()
+        if row is not None:
+            body = {field: row[field] for field in fields}
+    if row is None:
+        abort(404)
+    response = jsonify({"success": True, key: body})
+    response.set_etag(resource_etag(model, row, fields))
+    return response
+
+
+@routes_blueprint.route("/actors", methods=["GET"])
+@requires_auth(permission="get:actors")
+@response_cache.cached("actors")
+def show_actors(payload):
+    return list_resources(Actor, "actors", actor_conditions(), ACTOR_SORTS,
+                          ACTOR_FIELDS)
+
+
 @routes_blueprint.route("/movies", methods=["GET"])
 @requires_auth(permission="get:movies")
+@response_cache.cached("movies")
 def show_movies(payload):
-    movies = Movie.query.all()
-    if len(movies) == 0:
+    return list_resources(Movie, "movies", movie_conditions(), MOVIE_SORTS,
+                          MOVIE_FIELDS)
+
+
+@routes_blueprint.route("/actors/<int:id>", methods=["GET"])
+@requires_auth(permission="get:actors")
+@response_cache.cached("actors")
+def show_actor(payload, id):
+    return show_resource(Actor, "actor", id, ACTOR_FIELDS)
+
+
+@routes_blueprint.route("/movies/<int:id>", methods=["GET"])
+@requires_auth(permission="get:movies")
+@response_cache.cached("movies")
+def show_movie(payload, id):
+    return show_resource(Movie, "movie", id, MOVIE_FIELDS)
+
+
+@routes_blueprint.route("/actors/sync", methods=["GET"])
+@requires_auth(permission="get:actors")
+def sync_actors(payload):
+    return sync_changes(Actor, "actors", ACTOR_FIELDS)
+
+
+@routes_blueprint.route("/movies/sync", methods=["GET"])
+@requires_auth(permission="get:movies")
+def sync_movies(payload):
+    return sync_changes(Movie, "movies", MOVIE_FIELDS)
+
+
+def export_rows(model, fields):
+    """Streams every row of model as NDJSON, or as a JSON array when
+    format=json is requested, limited to the columns named by the fields
+    query parameter if it is given
+
+    Rows are read through a server side cursor in batches of
+    EXPORT_BATCH_SIZE and written out as they arrive, so memory use doesn't
+    depend on the size of the table.
+    """
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in ("ndjson", "json"):
+        abort(400)
+    fields = fields_arg(fields) or fields
+    query = select(select_columns(model, fields)).order_by(model.id)
+
+    def rows():
+        result = db.session.execute(
+            query.execution_options(stream_results=True))
+        while True:
+            batch = result.fetchmany(EXPORT_BATCH_SIZE)
+            if not batch:
+                break
+            for row in batch:
+                yield dumps({field: row[field] for field in fields})
+
+    def generate_ndjson():
+        for row in rows():
+            yield row + b"\n"
+
+    def generate_json():
+        separator = b"["
+        for row in rows():
+            yield separator + row
+            separator = b","
+        yield b"[]\n" if separator == b"[" else b"]\n"
+
+    if fmt == "json":
+        return Response(stream_with_context(generate_json()),
+                        mimetype="application/json")
+    return Response(stream_with_context(generate_ndjson()),
+                    mimetype="application/x-ndjson")
+
+
+@routes_blueprint.route("/actors/export", methods=["GET"])
+@requires_auth(permission="get:actors")
+def export_actors(payload):
+    return export_rows(Actor, ACTOR_FIELDS)
+
+
+@routes_blueprint.route("/movies/export", methods=["GET"])
+@requires_auth(permission="get:movies")
+def export_movies(payload):
+    return export_rows(Movie, MOVIE_FIELDS)
+
+
+@routes_blueprint.route("/search", methods=["GET"])
+@requires_auth(any_of=["get:actors", "get:movies"])
+def search_resources(payload):
+    """Ranked matches of q among actor names and movie titles, restricted
+    to the resources the token can read
+    """
+    q = request.args.get("q", "").strip()
+    if not q:
+        abort(400)
+    try:
+        limit = min(int(request.args.get("limit", 20)), SEARCH_MAX_RESULTS)
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+
+    granted = payload["permissions"]
+    response = {"success": True, "query": q}
+    if "get:actors" in granted:
+        matches = search(db.session, "actors", "name", q, limit)
+        response["actors"] = [{"id": id, "name": name, "score": score}
+                              for id, name, score in matches]
+    if "get:movies" in granted:
+        matches = search(db.session, "movies", "title", q, limit)
+        response["movies"] = [{"id": id, "title": title, "score": score}
+                              for id, title, score in matches]
+    return jsonify(response)
+
+
+def remove_resource(model, id):
+    """Deletes the row with the given id with a single DELETE, the number
+    of deleted rows tells whether it existed
+    """
+    try:
+        deleted = delete_rows(model, [id])
+    except Exception:
+        abort(422)
+    if deleted == 0:
         abort(404)
-    else:
-        movies = [m.format() for m in movies]
-        response = {"count": len(movies), "success": True, "movies": movies}
-        return jsonify(response)
+    return jsonify({"success": True, "deleted": id})
 
 
 @routes_blueprint.route("/actors/<int:id>", methods=["DELETE"])
 @requires_auth(permission="delete:actors")
+@response_cache.invalidates("actors")
 def remove_actor(payload, id):
-    try:
-        actor = Actor.query.filter_by(id=id).one_or_none()
-    except:
-        abort(404)
-    if actor is None:
-        abort(404)
-    else:
-        try:
-            actor.delete()
-            response = {"success": True, "deleted": id}
-            return jsonify(response)
-        except:
-            abort(422)
+    return remove_resource(Actor, id)
 
 
 @routes_blueprint.route("/movies/<int:id>", methods=["DELETE"])
 @requires_auth(permission="delete:movies")
+@response_cache.invalidates("movies")
 def remove_movie(payload, id):
+    return remove_resource(Movie, id)
+
+
+def prefers_representation():
+    """True when the client asked for the created resource with
+    Prefer: return=representation
+    """
+    preferences = request.headers.get("Prefer", "").replace(";", ",")
+    return "return=representation" in [
+        preference.strip().lower() for preference in preferences.split(",")]
+
+
+def create_resource(model, key, validate):
+    """Inserts the resource in the request body with a single INSERT. The
+    whole resource is returned under key when the client prefers it, built
+    from the validated values without reading the row back.
+    """
     try:
-        movie = Movie.query.filter_by(id=id).one_or_none()
-    except:
-        abort(404)
-    if movie is None:
-        abort(404)
-    else:
-        try:
-            movie.delete()
-            response = {"success": True, "deleted": id}
-            return jsonify(response)
-        except:
-            abort(422)
+        values = validate(request.get_json())
+    except ValidationError:
+        abort(400)
+    try:
+        id = insert_row(model, values)
+    except Exception:
+        abort(422)
+    resp = {"success": True, "created": id}
+    if not prefers_representation():
+        return jsonify(resp)
+    resp[key] = dict(values, id=id)
+    response = jsonify(resp)
+    response.headers["Preference-Applied"] = "return=representation"
+    return response
 
 
 @routes_blueprint.route("/actors", methods=["POST"])
 @requires_auth(permission="post:actors")
+@response_cache.invalidates("actors")
 def add_actor(payload):
-    data = request.get_json()
-    if ("name" in data) and ("age" in data) and ("gender" in data):
-        name = data["name"].lower()
-        age = data["age"]
-        gender = data["gender"].lower()
-        if gender not in ["male", "female"]:
-            abort(400)
-        actor = Actor(name, age, gender)
-        try:
-            actor.insert()
-            resp = {"success": True, "created": actor.id}
-            return jsonify(resp)
-        except:
-            abort(422)
-    else:
-        abort(400)
+    return create_resource(Actor, "actor", actor_values)
 
 
 @routes_blueprint.route("/movies", methods=["POST"])
 @requires_auth(permission="post:movies")
+@response_cache.invalidates("movies")
 def add_movie(payload):
-    data = request.get_json()
-    if ("title" in data) and ("release_date" in data):
-        title = data["title"].lower()
-        release_date = data["release_date"]
-        movie = Movie(title, release_date)
-        try:
-            movie.insert()
-            resp = {"success": True, "created": movie.id}
-            return jsonify(resp)
-        except:
-            abort(422)
-    else:
+    return create_resource(Movie, "movie", movie_values)
+
+
+@routes_blueprint.route("/actors/bulk", methods=["POST"])
+@requires_auth(permission="post:actors")
+@response_cache.invalidates("actors")
+def add_actors_bulk(payload):
+    return bulk.create(Actor, "actors", actor_values)
+
+
+@routes_blueprint.route("/movies/bulk", methods=["POST"])
+@requires_auth(permission="post:movies")
+@response_cache.invalidates("movies")
+def add_movies_bulk(payload):
+    return bulk.create(Movie, "movies", movie_values)
+
+
+@routes_blueprint.route("/actors/bulk", methods=["PATCH"])
+@requires_auth(permission="patch:actors")
+@response_cache.invalidates("actors")
+def update_actors_bulk(payload):
+    return bulk.update(Actor, "actors", actor_values)
+
+
+@routes_blueprint.route("/movies/bulk", methods=["PATCH"])
+@requires_auth(permission="patch:movies")
+@response_cache.invalidates("movies")
+def update_movies_bulk(payload):
+    return bulk.update(Movie, "movies", movie_values)
+
+
+@routes_blueprint.route("/actors/bulk", methods=["DELETE"])
+@requires_auth(permission="delete:actors")
+@response_cache.invalidates("actors")
+def remove_actors_bulk(payload):
+    return bulk.delete(Actor)
+
+
+@routes_blueprint.route("/movies/bulk", methods=["DELETE"])
+@requires_auth(permission="delete:movies")
+@response_cache.invalidates("movies")
+def remove_movies_bulk(payload):
+    return bulk.delete(Movie)
+
+
+def if_match_versions(model, id):
+    """The versions of the row listed in If-Match, None when the header is
+    missing or is *. Etags of other rows never match, whatever fields they
+    were sent with. Weak etags are accepted, they only differ from the
+    strong ones by the encoding of the response they came with.
+    """
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+    versions = []
+    for tag in if_match.as_set(include_weak=True):
+        parts = tag.split("-")
+        if (len(parts) == 4 and parts[0] == model.__tablename__
+                and parts[1] == str(id) and parts[2].isdigit()):
+            versions.append(int(parts[2]))
+    return versions
+
+
+def update_resource(model, id, validate, fields):
+    """Applies a PATCH payload to the row with the given id with a single
+    UPDATE, conditional on If-Match when the header is given. Answers 412
+    when the row exists but its version doesn't match. The ETag sent back
+    is the one of the row with all its fields.
+    """
+    try:
+        values = validate(request.get_json(), partial=True)
+    except ValidationError:
         abort(400)
+    versions = if_match_versions(model, id)
+    try:
+        row = update_row(model, id, values, versions)
+    except Exception:
+        abort(422)
+    if row is None:
+        if versions is not None and existing_ids(model, [id]):
+            abort(412)
+        abort(404)
+    response = jsonify({"success": True, "updated": id})
+    response.set_etag(resource_etag(model, row, fields))
+    return response
 
 
 @routes_blueprint.route("/actors/<int:id>", methods=["PATCH"])
 @requires_auth(permission="patch:actors")
+@response_cache.invalidates("actors")
 def update_actor(payload, id):
-    actor = Actor.query.filter_by(id=id).one_or_none()
-    if actor is None:
-        abort(404)
-    else:
-        data = request.get_json()
-        if ("name" in data) or ("age" in data) or ("gender" in data):
-            name = data.get("name", None)
-            age = data.get("age", None)
-            gender = data.get("gender", None)
-            if name is not None:
-                actor.name = name
-            if age is not None:
-                actor.age = age
-            if gender is not None:
-                actor.gender = gender
-            try:
-                actor.update()
-                resp = {"success": True, "updated": id}
-                return jsonify(resp)
-            except:
-                abort(422)
-        else:
-            abort(400)
+    return update_resource(Actor, id, actor_values, ACTOR_FIELDS)
 
 
 @routes_blueprint.route("/movies/<int:id>", methods=["PATCH"])
 @requires_auth(permission="patch:movies")
+@response_cache.invalidates("movies")
 def update_movie(payload, id):
-    movie = Movie.query.filter_by(id=id).one_or_none()
-    if movie is None:
+    return update_resource(Movie, id, movie_values, MOVIE_FIELDS)
+
+
+def _limit_arg(default):
+    limit = request.args.get("limit", default)
+    if not str(limit).isdigit() or not 1 <= int(limit) <= 500:
+        abort(400)
+    return int(limit)
+
+
+@routes_blueprint.route("/admin/profiles", methods=["GET"])
+@requires_auth(permission="admin:profile")
+def list_profiles(payload):
+    return jsonify({"success": True, "profiles": profiler.profiles()})
+
+
+@routes_blueprint.route("/admin/profiles/<id>", methods=["GET"])
+@requires_auth(permission="admin:profile")
+def show_profile(payload, id):
+    """The pstats listing of a profile, sorted by the sort query parameter
+    (cumulative by default). With format=prof the stats are sent in the
+    pstats file format, for snakeviz or pstats.Stats.
+    """
+    if request.args.get("format") == "prof":
+        raw = profiler.raw(id)
+        if raw is None:
+            abort(404)
+        return Response(raw, mimetype="application/octet-stream",
+                        headers={"Content-Disposition":
+                                 f"attachment; filename={id}.prof"})
+    sort = request.args.get("sort", "cumulative")
+    if sort not in SORT_KEYS:
+        abort(400)
+    report = profiler.report(id, sort, _limit_arg(30))
+    if report is None:
         abort(404)
-    else:
-        data = request.get_json()
-        if ("title" in data) or ("release_date" in data):
-            title = data.get("title", None)
-            release_date = data.get("release_date", None)
-            if title is not None:
-                movie.title = title
-            if release_date is not None:
-                movie.release_date = release_date
-            try:
-                movie.update()
-                resp = {"success": True, "updated": id}
-                return jsonify(resp)
-            except:
-                abort(422)
-        else:
-            abort(400)
+    return Response(report, mimetype="text/plain")
+
+
+def memory_response(id, statistics):
+    return jsonify({
+        "success": True,
+        "snapshot": id,
+        "traced_memory": memory_tracer.traced_memory(),
+        "statistics": statistics,
+    })
+
+
+@routes_blueprint.route("/admin/memory/snapshots", methods=["GET"])
+@requires_auth(permission="admin:profile")
+def list_snapshots(payload):
+    return jsonify({
+        "success": True,
+        "snapshots": memory_tracer.snapshots(),
+        "traced_memory": memory_tracer.traced_memory(),
+    })
+
+
+@routes_blueprint.route("/admin/memory/snapshots", methods=["POST"])
+@requires_auth(permission="admin:profile")
+def take_snapshot(payload):
+    id = memory_tracer.snapshot()
+    return memory_response(id, memory_tracer.statistics(
+        id, limit=_limit_arg(20)))
+
+
+@routes_blueprint.route("/admin/memory/snapshots/<int:id>", methods=["GET"])
+@requires_auth(permission="admin:profile")
+def show_snapshot(payload, id):
+    """Top allocations of a snapshot grouped by the key query parameter
+    (lineno, filename or traceback), or with compare=<snapshot id> the
+    allocations that grew the most since that snapshot
+    """
+    key = request.args.get("key", "lineno")
+    compare = request.args.get("compare")
+    if key not in ("lineno", "filename", "traceback") or (
+            compare is not None and not compare.isdigit()):
+        abort(400)
+    statistics = memory_tracer.statistics(
+        id, key, _limit_arg(20), int(compare) if compare else None)
+    if statistics is None:
+        abort(404)
+    return memory_response(id, statistics)
+
+
+@routes_blueprint.route("/admin/memory/snapshots", methods=["DELETE"])
+@requires_auth(permission="admin:profile")
+def stop_tracing(payload):
+    memory_tracer.stop()
+    return jsonify({"success": True})
@@ -0,0 +1,90 @@
+import os
+import datetime
+from flask import abort
+from sqlalchemy import select, and_
+from ..models.models import Tombstone, db, utc_now
+from ..serializer import jsonify
+from ..timing import phase
+from .pagination import page_args, keyset_page, encode_cursor, _cursor_value
+from .filters import fields_arg, select_columns
+
+SYNC_LAG = float(os.environ.get("SYNC_LAG", 5))
+SYNC_RETENTION_DAYS = int(os.environ.get("SYNC_RETENTION_DAYS", 30))
+
+"""
+Incremental sync of the actors and movies
+
+A sync returns the rows updated and the ids deleted since the cursor of the
+previous sync. Both are read in (timestamp, id) order through the
+updated_at and tombstone indexes, so the cost follows the number of
+changes, not the size of the table.
+
+The cursor holds [synced_at, updated_at, id, deleted_at, tombstone id]:
+the position reached in both streams, and the time up to which every
+deletion has been reported. Changes younger than SYNC_LAG seconds are left
+for the next sync, so a transaction that commits a little after its
+timestamp was taken isn't skipped. The timestamps and the time a sync
+runs up to are all read from the database clock, app servers whose clocks
+disagree can't make changes fall behind a cursor. Tombstones older than
+SYNC_RETENTION_DAYS can be pruned, cursors older than that get a 410 and
+have to start over with a full sync.
+"""
+
+
+def _position(since, start):
+    if since[start] is None or since[start + 1] is None:
+        return None
+    return since[start:start + 2]
+
+
+def sync_changes(model, key, fields):
+    limit, since = page_args("since")
+    # the clock that stamped the rows
+    now = db.session.execute(select([utc_now().label("now")])).scalar()
+    until = now - datetime.timedelta(seconds=SYNC_LAG)
+    rows_after = None
+    if since is None:
+        # a full sync, earlier deletions don't concern the client
+        tombstones_after = [until, 0]
+    else:
+        if len(since) != 5:
+            abort(400)
+        synced_at = _cursor_value(Tombstone.deleted_at, since[0])
+        if synced_at < now - datetime.timedelta(days=SYNC_RETENTION_DAYS):
+            abort(410)
+        rows_after = _position(since, 1)
+        tombstones_after = _position(since, 3)
+
+    fields = fields_arg(fields) or fields
+    table = model.__table__
+    query = select(select_columns(model, fields, model.updated_at)).where(
+        table.c.updated_at <= until)
+    rows, more_rows = keyset_page(query, [table.c.updated_at, table.c.id],
+                                  limit, rows_after)
+
+    tombstones = Tombstone.__table__
+    query = select([tombstones.c.id, tombstones.c.resource_id,
+                    tombstones.c.deleted_at]).where(and_(
+                        tombstones.c.resource == table.name,
+                        tombstones.c.deleted_at <= until))
+    deleted, more_deleted = keyset_page(
+        query, [tombstones.c.deleted_at, tombstones.c.id], limit,
+        tombstones_after)
+
+    if rows:
+        rows_after = [rows[-1].updated_at, rows[-1].id]
+    if deleted:
+        tombstones_after = [deleted[-1].deleted_at, deleted[-1].id]
+    # every deletion up to synced_at has been reported
+    synced_at = deleted[-1].deleted_at if more_deleted else until
+    cursor = [synced_at] + (rows_after or [None, None]) + \
+        (tombstones_after or [None, None])
+    with phase("format"):
+        rows = [{field: row[field] for field in fields} for row in rows]
+    return jsonify({
+        "success": True,
+        key: rows,
+        "deleted": [row.resource_id for row in deleted],
+        "next_cursor": encode_cursor(cursor),
+        "has_more": more_rows or more_deleted,
+    })
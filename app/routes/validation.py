@@ -0,0 +1,86 @@
+import datetime
+
+GENDERS = ["male", "female"]
+DATE_FORMATS = ["%d/%m/%Y", "%Y-%m-%d", "%Y-%m-%dT%H:%M:%S"]
+
+"""
+Validation of actor and movie payloads, shared by the single and the bulk
+endpoints. Each function returns the column values to write, or raises a
+ValidationError naming the offending field.
+"""
+
+
+class ValidationError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+def parse_release_date(value):
+    """Parses dd/mm/yyyy or an ISO 8601 date into a datetime"""
+    if isinstance(value, str):
+        for fmt in DATE_FORMATS:
+            try:
+                return datetime.datetime.strptime(value, fmt)
+            except ValueError:
+                continue
+    raise ValidationError("release_date must be a dd/mm/yyyy date")
+
+
+def _name(value, field):
+    if not isinstance(value, str) or not value.strip():
+        raise ValidationError(f"{field} must be a non empty string")
+    return value.lower()
+
+
+def _age(value):
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ValidationError("age must be a non negative integer")
+    return value
+
+
+def _gender(value):
+    if not isinstance(value, str) or value.lower() not in GENDERS:
+        raise ValidationError("gender must be male or female")
+    return value.lower()
+
+
+def actor_values(data, partial=False):
+    """Validates an actor payload, with partial=True any subset of the
+    fields is accepted as long as there is at least one
+    """
+    if not isinstance(data, dict):
+        raise ValidationError("actor must be an object")
+    fields = {"name": lambda v: _name(v, "name"), "age": _age,
+              "gender": _gender}
+    return _values(data, fields, partial)
+
+
+def movie_values(data, partial=False):
+    """Validates a movie payload, see actor_values"""
+    if not isinstance(data, dict):
+        raise ValidationError("movie must be an object")
+    fields = {"title": lambda v: _name(v, "title"),
+              "release_date": parse_release_date}
+    return _values(data, fields, partial)
+
+
+def _values(data, fields, partial):
+    values = {}
+    for field, validate in fields.items():
+        if data.get(field) is not None:
+            values[field] = validate(data[field])
+        elif not partial:
+            raise ValidationError(f"{field} is required")
+    if not values:
+        raise ValidationError(
+            "at least one of " + ", ".join(fields) + " is required")
+    return values
+
+
+def resource_id(data):
+    """Returns the id of a bulk update item"""
+    value = data.get("id") if isinstance(data, dict) else None
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValidationError("id must be an integer")
+    return value
@@ -0,0 +1,104 @@
+import os
+import re
+from flask import current_app, json
+from .timing import phase
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+"""
+JSON serialization of the API responses
+
+Flask 1.x encodes every response with the stdlib json module. When orjson
+is installed it is used instead, configured to produce exactly the bytes
+Flask would: sorted keys, no whitespace, datetimes as HTTP dates and any
+other type handed to the app's json_encoder. The few values orjson writes
+differently (non ASCII text, floats in exponent notation, integers past 64
+bits, non string keys) send the payload through the stdlib encoder, so the
+output doesn't depend on which encoder ran. The exception is NaN and the
+infinities, which orjson writes as null where the stdlib writes invalid
+JSON; the API never produces them.
+"""
+
+# a float the stdlib writes in exponent notation, or text in a string that
+# it escapes; a match only costs a fallback to the stdlib encoder
+_STDLIB_ONLY = re.compile(rb"[0-9](?:e|\.0000)|[\x7f-\xff]")
+_STDLIB_ONLY_UNICODE = re.compile(rb"[0-9](?:e|\.0000)")
+
+
+class JSONSerializer:
+    def __init__(self):
+        self.fast = orjson is not None
+
+    def init_app(self, app):
+        """Picks the encoder from JSON_ENCODER: auto (orjson if installed,
+        the default), orjson or stdlib
+        """
+        kind = os.environ.get("JSON_ENCODER", "auto")
+        if kind == "auto":
+            self.fast = orjson is not None
+        elif kind == "orjson":
+            if orjson is None:
+                raise ValueError("JSON_ENCODER=orjson needs orjson installed")
+            self.fast = True
+        elif kind == "stdlib":
+            self.fast = False
+        else:
+            raise ValueError(f"Unknown JSON_ENCODER {kind}")
+        app.extensions["json_serializer"] = self
+
+    def _fast_dumps(self, obj):
+        """Encodes obj with orjson, returns None when the stdlib encoder
+        has to be used
+        """
+        config = current_app.config
+        if config["JSONIFY_PRETTYPRINT_REGULAR"] or current_app.debug:
+            return None
+        encoder = current_app.json_encoder()
+        options = orjson.OPT_PASSTHROUGH_DATETIME | \
+            orjson.OPT_PASSTHROUGH_DATACLASS
+        if config["JSON_SORT_KEYS"]:
+            options |= orjson.OPT_SORT_KEYS
+        try:
+            raw = orjson.dumps(obj, default=encoder.default, option=options)
+        except TypeError:
+            return None
+        pattern = _STDLIB_ONLY if config["JSON_AS_ASCII"] else \
+            _STDLIB_ONLY_UNICODE
+        if pattern.search(raw):
+            return None
+        return raw
+
+    def dumps(self, obj):
+        """Serializes obj to compact JSON bytes, the same bytes as
+        flask.json.dumps(obj, separators=(",", ":")) outside debug mode
+        """
+        if self.fast:
+            raw = self._fast_dumps(obj)
+            if raw is not None:
+                return raw
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+    def jsonify(self, *args, **kwargs):
+        """Drop in replacement of flask.jsonify"""
+        if args and kwargs:
+            raise TypeError(
+                "jsonify() behavior undefined when passed both args and "
+                "kwargs")
+        elif len(args) == 1:
+            data = args[0]
+        else:
+            data = args or kwargs
+        with phase("serialize"):
+            raw = self._fast_dumps(data) if self.fast else None
+            if raw is None:
+                return json.jsonify(data)
+            return current_app.response_class(
+                raw + b"\n", mimetype=current_app.config["JSONIFY_MIMETYPE"])
+
+
+serializer = JSONSerializer()
+jsonify = serializer.jsonify
+dumps = serializer.dumps
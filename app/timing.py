@@ -0,0 +1,103 @@
+import os
+import time
+from contextlib import contextmanager
+from flask import g, request, has_app_context, has_request_context
+from .metrics import registry, Histogram
+
+"""
+Timing of the phases of each request
+
+requires_auth, the JSON serializer, the response compression and every SQL
+statement add the time they take to the phase they belong to:
+
+auth       reading and verifying the token and checking its permissions
+jwks       fetching the signing keys, part of auth
+db         executing SQL statements, fetching streamed rows isn't included,
+           recorded by app/models/queries.py
+format     fetching the rows of a result and turning them into dicts, the
+           driver may read the rows from the database while they are
+           fetched (SQLite does)
+serialize  encoding the JSON responses
+compress   compressing the responses
+
+The phases and the total time are sent in a Server-Timing header and
+recorded in per route histograms on /metrics. The body of streamed
+responses is generated after the timings are taken, so it isn't included.
+"""
+
+request_duration = registry.register(Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling requests, until the response is returned",
+    labelnames=("method", "route", "status"),
+))
+
+phase_duration = registry.register(Histogram(
+    "http_request_phase_seconds",
+    "Time spent in each phase of the requests",
+    labelnames=("route", "phase"),
+))
+
+
+def record(name, seconds):
+    """Adds seconds to the phase name of the current request, outside of a
+    request nothing is recorded
+    """
+    if has_app_context():
+        timings = g.get("timings")
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def current_route():
+    """The url rule of the current request, the label of its metrics"""
+    if not has_request_context():
+        return None
+    rule = request.url_rule
+    return rule.rule if rule is not None else "unmatched"
+
+
+class Timing:
+    def init_app(self, app):
+        """Reads SERVER_TIMING, 0 keeps the Server-Timing header out of
+        the responses, the histograms are still recorded
+        """
+        self.header = os.environ.get("SERVER_TIMING", "1").lower() in (
+            "1", "true", "yes")
+        app.before_request(self.start)
+        # registered before the other after_request functions, so it runs
+        # after them and the compression is timed
+        app.after_request(self.finish)
+        app.extensions["timing"] = self
+
+    def start(self):
+        g.timings = {}
+        g.request_started = time.perf_counter()
+
+    def finish(self, response):
+        timings = g.pop("timings", None)
+        if timings is None:
+            return response
+        total = time.perf_counter() - g.request_started
+        route = current_route()
+        for name, seconds in timings.items():
+            phase_duration.observe(seconds, route, name)
+        request_duration.observe(total, request.method, route,
+                                 response.status_code)
+        if self.header:
+            entries = [f"{name};dur={seconds * 1000:.3f}"
+                       for name, seconds in timings.items()]
+            entries.append(f"total;dur={total * 1000:.3f}")
+            response.headers["Server-Timing"] = ", ".join(entries)
+        return response
+
+
+timing = Timing()
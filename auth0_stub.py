@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import base64
+import tempfile
+from jose import jwt
+
+"""
+Local stand-in for the Auth0 tenant, for the benchmarks and the tests
+
+It owns an RSA key, publishes the public half as a JWKS file and signs
+RS256 tokens for the roles of the api, so requires_auth can verify tokens
+without network access. install() has to run before the app is imported,
+the auth module reads its settings at import time.
+"""
+
+DOMAIN = "casting.stub.auth0.local"
+AUDIENCE = "casting"
+KID = "auth0-stub"
+
+ROLES = {
+    "casting_assistant": ["get:actors", "get:movies"],
+    "casting_director": ["get:actors", "get:movies", "post:actors",
+                         "patch:actors", "delete:actors", "patch:movies"],
+    "executive_producer": ["get:actors", "get:movies", "post:actors",
+                           "post:movies", "patch:actors", "patch:movies",
+                           "delete:actors", "delete:movies"],
+}
+
+
+def _b64(number):
+    raw = number.to_bytes((number.bit_length() + 7) // 8, "big")
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def generate_key(bits=2048):
+    """Returns (private key PEM, modulus, public exponent), generated with
+    whichever of pycryptodome, cryptography or rsa is installed (rsa comes
+    with python-jose but is the slowest)
+    """
+    try:
+        from Crypto.PublicKey import RSA
+
+        key = RSA.generate(bits)
+        return key.export_key().decode(), key.n, key.e
+    except ImportError:
+        pass
+    try:
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        key = rsa.generate_private_key(65537, bits, default_backend())
+        pem = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption())
+        numbers = key.public_key().public_numbers()
+        return pem.decode(), numbers.n, numbers.e
+    except ImportError:
+        pass
+    import rsa
+
+    public, private = rsa.newkeys(bits)
+    return private.save_pkcs1().decode(), public.n, public.e
+
+
+class Auth0Stub:
+    def __init__(self, domain=DOMAIN, audience=AUDIENCE, kid=KID,
+                 bits=2048):
+        self.domain = domain
+        self.audience = audience
+        self.kid = kid
+        self.pem, self.n, self.e = generate_key(bits)
+        self.jwks_path = None
+
+    def jwks(self):
+        return {"keys": [{"kty": "RSA", "kid": self.kid, "use": "sig",
+                          "alg": "RS256", "n": _b64(self.n),
+                          "e": _b64(self.e)}]}
+
+    def write_jwks(self, path=None):
+        """Writes the JWKS to path (a new temporary file by default) and
+        returns its file:// url
+        """
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="jwks-", suffix=".json")
+            os.close(fd)
+        with open(path, "w") as f:
+            json.dump(self.jwks(), f)
+        self.jwks_path = path
+        return "file://" + os.path.abspath(path)
+
+    def install(self, environ=os.environ):
+        """Points the auth settings of the app at this stub"""
+        environ["AUTH0_DOMAIN"] = self.domain
+        environ["API_AUDIENCE"] = self.audience
+        environ["ALGORITHMS"] = "RS256"
+        environ["JWKS_URL"] = self.write_jwks(self.jwks_path)
+        environ.setdefault("CLIENT_ID", "auth0-stub")
+        environ.setdefault("CALLBACK_URL", "http://localhost:5000/api/token")
+
+    def token(self, permissions, expires_in=3600, subject="auth0|stub"):
+        now = int(time.time())
+        claims = {
+            "iss": f"https://{self.domain}/",
+            "sub": subject,
+            "aud": self.audience,
+            "iat": now,
+            "exp": now + expires_in,
+            "permissions": list(permissions),
+        }
+        return jwt.encode(claims, self.pem, algorithm="RS256",
+                          headers={"kid": self.kid})
+
+    def role_token(self, role, **kwargs):
+        return self.token(ROLES[role], **kwargs)
+
+    def headers(self, role):
+        """Authorization header of a fresh token for role"""
+        return {"Authorization": "Bearer " + self.role_token(role)}
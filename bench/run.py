@@ -0,0 +1,237 @@
+"""
+Load test of the api, fully offline
+
+    python -m bench.run --size 10000 --duration 5 --concurrency 4
+
+Seeds a database (a temporary SQLite file, or --database-url), signs role
+tokens with the local Auth0 stub and drives every scenario of
+bench/scenarios.py through the WSGI app in process for --duration seconds
+from --concurrency threads. Reports requests per second, p50/p95/p99
+latencies in milliseconds and the resident memory of the process after
+each scenario.
+
+With --baseline the results are compared against a previous run saved with
+--save-baseline: a scenario regresses when its throughput drops or its p99
+grows by more than --tolerance (20% by default), and any regression makes
+the run exit with status 1.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from auth0_stub import Auth0Stub  # noqa: E402
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--size", type=int, default=1000,
+                        help="actors and movies seeded, 1000 to 1000000")
+    parser.add_argument("--database-url",
+                        help="database to seed, its tables are dropped. "
+                             "Defaults to a temporary SQLite file")
+    parser.add_argument("--duration", type=float, default=5,
+                        help="seconds each scenario runs")
+    parser.add_argument("--warmup", type=float, default=1,
+                        help="seconds each scenario runs before measuring")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="threads sending requests")
+    parser.add_argument("--scenario", action="append",
+                        help="run only this scenario, can be repeated")
+    parser.add_argument("--response-cache", action="store_true",
+                        help="keep the response cache on, it is disabled "
+                             "by default so the handlers are measured")
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against this file")
+    parser.add_argument("--save-baseline",
+                        help="save the results as a baseline to this file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed regression, as a fraction")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of sorted values"""
+    if not values:
+        return None
+    index = max(int(round(fraction * len(values) + 0.5)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def rss_mb():
+    """Resident memory of the process in MiB"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        import resource
+
+        # peak rather than current memory where /proc isn't available
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def run_scenario(app, scenario, headers, duration, warmup, concurrency,
+                 seed):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    start = time.perf_counter()
+    measure_from = start + warmup
+    stop = measure_from + duration
+
+    def worker(index):
+        client = app.test_client()
+        rng = random.Random(seed * 1000 + index)
+        own = []
+        own_errors = 0
+        while True:
+            method, path, body = scenario.request(rng)
+            started = time.perf_counter()
+            if started >= stop:
+                break
+            response = client.open(path, method=method, json=body,
+                                   headers=headers)
+            response.get_data()
+            finished = time.perf_counter()
+            if started >= measure_from:
+                own.append(finished - started)
+                if response.status_code not in scenario.statuses:
+                    own_errors += 1
+        with lock:
+            latencies.extend(own)
+            errors.append(own_errors)
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": sum(errors),
+        "rps": len(latencies) / duration,
+        "p50_ms": _ms(percentile(latencies, 0.50)),
+        "p95_ms": _ms(percentile(latencies, 0.95)),
+        "p99_ms": _ms(percentile(latencies, 0.99)),
+        "rss_mb": round(rss_mb(), 1),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def compare(results, baseline, tolerance):
+    """Returns the regressions of results against baseline as messages"""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if result["rps"] < previous["rps"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: {result['rps']:.1f} rps, baseline "
+                f"{previous['rps']:.1f}")
+        if (result["p99_ms"] is not None and previous["p99_ms"] is not None
+                and result["p99_ms"] > previous["p99_ms"] * (1 + tolerance)):
+            regressions.append(
+                f"{name}: p99 {result['p99_ms']:.2f} ms, baseline "
+                f"{previous['p99_ms']:.2f} ms")
+        if result["errors"] and not previous.get("errors"):
+            regressions.append(f"{name}: {result['errors']} errors")
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    stub = Auth0Stub()
+    stub.install()
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        directory = tempfile.TemporaryDirectory(prefix="casting-bench-")
+        os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(
+            directory.name, "bench.db")
+    if not args.response_cache:
+        os.environ["RESPONSE_CACHE"] = "none"
+
+    from app import create_app
+    from app.models.models import db
+    from bench.scenarios import scenarios
+    from bench.seed import seed
+
+    app = create_app()
+    with app.app_context():
+        started = time.perf_counter()
+        seed(db, args.size, args.seed)
+        print(f"Seeded {args.size} actors and movies in "
+              f"{time.perf_counter() - started:.1f}s")
+
+    selected = scenarios(args.size)
+    if args.scenario:
+        unknown = set(args.scenario) - {s.name for s in selected}
+        if unknown:
+            sys.exit("Unknown scenarios: " + ", ".join(sorted(unknown)))
+        selected = [s for s in selected if s.name in args.scenario]
+
+    headers = {role: stub.headers(role) for role in
+               {s.role for s in selected if s.role is not None}}
+    results = {}
+    print(f"{'scenario':<24}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'p99 ms':>10}{'errors':>8}{'rss MiB':>10}")
+    for scenario in selected:
+        result = run_scenario(app, scenario, headers.get(scenario.role),
+                              args.duration, args.warmup, args.concurrency,
+                              args.seed)
+        results[scenario.name] = result
+        print(f"{scenario.name:<24}{result['rps']:>10.1f}"
+              f"{_fmt(result['p50_ms'])}{_fmt(result['p95_ms'])}"
+              f"{_fmt(result['p99_ms'])}{result['errors']:>8}"
+              f"{result['rss_mb']:>10.1f}")
+
+    with app.app_context():
+        database = db.engine.dialect.name
+    report = {"size": args.size, "concurrency": args.concurrency,
+              "database": database, "results": results}
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if (baseline.get("size"), baseline.get("concurrency")) != \
+                (args.size, args.concurrency):
+            print("Warning: the baseline was run with another --size or "
+                  "--concurrency")
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if regressions:
+            print("Regressions against the baseline:")
+            for regression in regressions:
+                print("  " + regression)
+            return 1
+        print("No regression against the baseline")
+    return 0
+
+
+def _fmt(value):
+    return f"{'-':>10}" if value is None else f"{value:>10.2f}"
+
+
+if __name__ == "__main__":
+    sys.exit(main())
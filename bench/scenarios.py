@@ -0,0 +1,134 @@
+import itertools
+from collections import namedtuple
+
+"""
+One scenario per route of app/routes/routes.py, except the Auth0 login
+redirect and token page which only render static content and the /admin
+profiling routes. Each request
+function gets a random generator and the size of the seeded tables and
+returns (method, path, json body or None).
+
+Reads come first and writes last, the delete scenarios consume ids from
+the top of the seeded range so the other scenarios keep their rows.
+"""
+
+Scenario = namedtuple("Scenario", ["name", "role", "request", "statuses"])
+
+OK = (200,)
+
+
+def _id(rng, size):
+    return rng.randint(1, max(size // 2, 1))
+
+
+def _actor(rng):
+    return {"name": f"bench actor {rng.random()}",
+            "age": rng.randint(18, 90),
+            "gender": rng.choice(["male", "female"])}
+
+
+def _movie(rng):
+    return {"title": f"bench movie {rng.random()}",
+            "release_date": f"{rng.randint(1, 28):02d}/"
+                            f"{rng.randint(1, 12):02d}/"
+                            f"{rng.randint(1950, 2025)}"}
+
+
+def scenarios(size):
+    # shared by the threads, next() on itertools.count is atomic
+    deletes = {"actors": itertools.count(size, -1),
+               "movies": itertools.count(size, -1)}
+
+    def delete_ids(resource, count):
+        # once the top half of the ids is used up the deletes miss
+        ids = [next(deletes[resource]) for _ in range(count)]
+        return [id if id > size // 2 else -id for id in ids]
+
+    def delete(resource):
+        def request(rng):
+            id, = delete_ids(resource, 1)
+            return "DELETE", f"/api/{resource}/{id}", None
+
+        return request
+
+    def delete_bulk(resource):
+        def request(rng):
+            return ("DELETE", f"/api/{resource}/bulk",
+                    {"ids": delete_ids(resource, 20)})
+
+        return request
+
+    def ids_sample(rng):
+        return rng.sample(range(1, size // 2 + 1), min(100, size // 2))
+
+    return [
+        Scenario("status", None,
+                 lambda rng: ("GET", "/api/status", None), OK),
+        Scenario("list_actors", "casting_assistant",
+                 lambda rng: ("GET", "/api/actors", None), OK),
+        Scenario("list_actors_filtered", "casting_assistant",
+                 lambda rng: ("GET", "/api/actors?gender=female&min_age="
+                              f"{rng.randint(18, 80)}&sort=-age&limit=50",
+                              None), OK),
+        Scenario("list_movies_sorted", "casting_assistant",
+                 lambda rng: ("GET", "/api/movies?sort=release_date"
+                              "&fields=id,title", None), OK),
+        Scenario("count_actors", "casting_assistant",
+                 lambda rng: ("GET", "/api/actors?count_only=1&min_age="
+                              f"{rng.randint(18, 80)}", None), OK),
+        Scenario("get_actor", "casting_assistant",
+                 lambda rng: ("GET", f"/api/actors/{_id(rng, size)}", None),
+                 OK),
+        Scenario("get_movie", "casting_assistant",
+                 lambda rng: ("GET", f"/api/movies/{_id(rng, size)}", None),
+                 OK),
+        Scenario("get_movies_by_ids", "casting_assistant",
+                 lambda rng: ("GET", "/api/movies?ids=" + ",".join(
+                     str(_id(rng, size)) for _ in range(20)), None), OK),
+        Scenario("search", "casting_assistant",
+                 lambda rng: ("GET", "/api/search?q=" + rng.choice(
+                     ["red", "night riv", "gold", "storm king"]), None), OK),
+        Scenario("sync_actors", "casting_assistant",
+                 lambda rng: ("GET", "/api/actors/sync?limit=100", None), OK),
+        Scenario("sync_movies", "casting_assistant",
+                 lambda rng: ("GET", "/api/movies/sync?limit=100", None), OK),
+        Scenario("export_actors", "casting_assistant",
+                 lambda rng: ("GET", "/api/actors/export", None), OK),
+        Scenario("export_movies", "casting_assistant",
+                 lambda rng: ("GET", "/api/movies/export?fields=id,title",
+                              None), OK),
+        Scenario("post_actor", "executive_producer",
+                 lambda rng: ("POST", "/api/actors", _actor(rng)), OK),
+        Scenario("post_movie", "executive_producer",
+                 lambda rng: ("POST", "/api/movies", _movie(rng)), OK),
+        Scenario("post_actors_bulk", "executive_producer",
+                 lambda rng: ("POST", "/api/actors/bulk",
+                              {"actors": [_actor(rng) for _ in range(100)]}),
+                 OK),
+        Scenario("post_movies_bulk", "executive_producer",
+                 lambda rng: ("POST", "/api/movies/bulk",
+                              {"movies": [_movie(rng) for _ in range(100)]}),
+                 OK),
+        Scenario("patch_actor", "executive_producer",
+                 lambda rng: ("PATCH", f"/api/actors/{_id(rng, size)}",
+                              {"age": rng.randint(18, 90)}), OK),
+        Scenario("patch_movie", "executive_producer",
+                 lambda rng: ("PATCH", f"/api/movies/{_id(rng, size)}",
+                              {"title": f"bench title {rng.random()}"}), OK),
+        Scenario("patch_actors_bulk", "executive_producer",
+                 lambda rng: ("PATCH", "/api/actors/bulk", {"actors": [
+                     {"id": id, "age": rng.randint(18, 90)}
+                     for id in ids_sample(rng)]}), OK),
+        Scenario("patch_movies_bulk", "executive_producer",
+                 lambda rng: ("PATCH", "/api/movies/bulk", {"movies": [
+                     {"id": id, "title": f"bench title {rng.random()}"}
+                     for id in ids_sample(rng)]}), OK),
+        Scenario("delete_actor", "executive_producer", delete("actors"),
+                 (200, 404)),
+        Scenario("delete_movie", "executive_producer", delete("movies"),
+                 (200, 404)),
+        Scenario("delete_actors_bulk", "executive_producer",
+                 delete_bulk("actors"), OK),
+        Scenario("delete_movies_bulk", "executive_producer",
+                 delete_bulk("movies"), OK),
+    ]
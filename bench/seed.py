@@ -0,0 +1,67 @@
+import random
+import datetime
+
+"""
+Fixtures of the benchmarks: fills the actors and movies tables with
+size rows each. The data is random but the same for a given seed, so runs
+stay comparable.
+"""
+
+GENDERS = ["male", "female"]
+WORDS = ["red", "blue", "night", "day", "river", "city", "last", "first",
+         "dark", "silent", "golden", "lost", "wild", "broken", "summer",
+         "winter", "king", "queen", "shadow", "storm"]
+CHUNK_SIZE = 5000
+
+
+def actor_rows(size, rng):
+    for i in range(size):
+        yield {"name": f"{rng.choice(WORDS)} {rng.choice(WORDS)} {i}",
+               "age": rng.randint(18, 90),
+               "gender": rng.choice(GENDERS),
+               "version": 1}
+
+
+def movie_rows(size, rng):
+    start = datetime.datetime(1950, 1, 1)
+    for i in range(size):
+        title = " ".join(rng.choice(WORDS) for _ in range(3))
+        yield {"title": f"{title} {i}",
+               "release_date": start + datetime.timedelta(
+                   days=rng.randint(0, 365 * 75)),
+               "version": 1}
+
+
+def insert_rows(db, table, rows):
+    """Inserts rows in chunks of CHUNK_SIZE, one multi row INSERT per chunk
+    on Postgres and an executemany elsewhere (SQLite caps the number of
+    bind parameters of a statement)
+    """
+    multi_values = db.engine.dialect.name == "postgresql"
+    chunk = []
+
+    def flush():
+        if multi_values:
+            db.session.execute(table.insert().values(chunk))
+        else:
+            db.session.execute(table.insert(), chunk)
+        db.session.commit()
+        chunk.clear()
+
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            flush()
+    if chunk:
+        flush()
+
+
+def seed(db, size, seed=0):
+    """Recreates the tables and inserts size actors and size movies"""
+    from app.models.models import Actor, Movie
+
+    db.drop_all()
+    db.create_all()
+    rng = random.Random(seed)
+    insert_rows(db, Actor.__table__, actor_rows(size, rng))
+    insert_rows(db, Movie.__table__, movie_rows(size, rng))
@@ -1,8 +1,10 @@
+import datetime
 from flask_script import Manager
-from flask_migrate import Migrate, MigrateCommand
+from flask_migrate import Migrate, MigrateCommand, stamp
 
 from app import create_app
-from app.models.models import db
+from app.models.models import db, prune_tombstones as prune
+from app.routes.sync import SYNC_RETENTION_DAYS
 
 app = create_app()
 migrate = Migrate(app, db)
@@ -11,5 +13,24 @@ manager = Manager(app)
 manager.add_command("db", MigrateCommand)
 
 
+@manager.option("--drop", action="store_true", help="Drop existing tables")
+def init_db(drop=False):
+    """Creates the tables of a fresh database and marks it as migrated to
+    the latest revision
+    """
+    if drop:
+        db.drop_all()
+    db.create_all()
+    stamp()
+
+
+@manager.option("--days", type=int, default=SYNC_RETENTION_DAYS,
+                help="Age in days of the oldest tombstones kept")
+def prune_tombstones(days=SYNC_RETENTION_DAYS):
+    """Deletes the tombstones older than the sync retention period"""
+    before = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    print(f"Pruned {prune(before)} tombstones")
+
+
 if __name__ == "__main__":
     manager.run()
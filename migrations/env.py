@@ -29,6 +29,16 @@ config.set_main_option(
 )
 target_metadata = current_app.extensions["migrate"].db.metadata
 
+
+def include_object(object, name, type_, reflected, compare_to):
+    """Keeps autogenerate away from the SQLite FTS5 search tables, they are
+    managed by app.models.search rather than the models' metadata
+    """
+    if type_ == "table" and reflected and "_fts" in name:
+        return name.split("_fts")[0] not in target_metadata.tables
+    return True
+
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -48,7 +58,12 @@ def run_migrations_offline():
 
     """
     url = config.get_main_option("sqlalchemy.url")
-    context.configure(url=url, target_metadata=target_metadata, literal_binds=True)
+    context.configure(
+        url=url,
+        target_metadata=target_metadata,
+        include_object=include_object,
+        literal_binds=True,
+    )
 
     with context.begin_transaction():
         context.run_migrations()
@@ -82,6 +97,7 @@ def run_migrations_online():
         context.configure(
             connection=connection,
             target_metadata=target_metadata,
+            include_object=include_object,
             process_revision_directives=process_revision_directives,
             **current_app.extensions["migrate"].configure_args
         )
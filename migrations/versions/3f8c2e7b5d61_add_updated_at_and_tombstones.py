@@ -0,0 +1,77 @@
+"""add updated_at and tombstones
+
+Revision ID: 3f8c2e7b5d61
+Revises: e91b6d2f4a18
+Create Date: 2026-10-17 17:26:03.581447
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app.models.search import sqlite_fts_statements
+
+
+# revision identifiers, used by Alembic.
+revision = '3f8c2e7b5d61'
+down_revision = 'e91b6d2f4a18'
+branch_labels = None
+depends_on = None
+
+SEARCHED_COLUMNS = [('actors', 'name'), ('movies', 'title')]
+
+# the UTC time on the database clock, as app.models.models.utc_now
+UTC_NOW = {
+    'postgresql': "(now() at time zone 'utc')",
+    'sqlite': "(strftime('%Y-%m-%d %H:%M:%f000', 'now'))",
+}
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    utc_now = sa.text(UTC_NOW.get(dialect, 'CURRENT_TIMESTAMP'))
+    # existing rows get the time of the migration
+    for table, _ in SEARCHED_COLUMNS:
+        column = sa.Column('updated_at', sa.DateTime(), nullable=False,
+                           server_default=utc_now)
+        if dialect == 'sqlite':
+            # SQLite can't add a column with a non constant default, batch
+            # mode copies the table instead
+            with op.batch_alter_table(table, recreate='always') as batch_op:
+                batch_op.add_column(column)
+        else:
+            op.add_column(table, column)
+        op.create_index(f'ix_{table}_updated_at', table,
+                        ['updated_at', 'id'], unique=False)
+    if dialect == 'sqlite':
+        _restore_search_triggers()
+
+    op.create_table(
+        'tombstones',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('resource', sa.String(length=20), nullable=False),
+        sa.Column('resource_id', sa.Integer(), nullable=False),
+        sa.Column('deleted_at', sa.DateTime(), nullable=False,
+                  server_default=utc_now),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_tombstones_resource_deleted_at', 'tombstones',
+                    ['resource', 'deleted_at', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_tombstones_resource_deleted_at',
+                  table_name='tombstones')
+    op.drop_table('tombstones')
+    for table, _ in reversed(SEARCHED_COLUMNS):
+        op.drop_index(f'ix_{table}_updated_at', table_name=table)
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('updated_at')
+    if op.get_bind().dialect.name == 'sqlite':
+        _restore_search_triggers()
+
+
+def _restore_search_triggers():
+    # copying a table in batch mode drops its triggers
+    for table, column in SEARCHED_COLUMNS:
+        for statement in sqlite_fts_statements(table, column):
+            op.execute(statement)
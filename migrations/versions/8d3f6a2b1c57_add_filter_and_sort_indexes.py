@@ -0,0 +1,39 @@
+"""add filter and sort indexes
+
+Revision ID: 8d3f6a2b1c57
+Revises: 5a2b8c1d9e40
+Create Date: 2026-10-17 11:03:27.540912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d3f6a2b1c57'
+down_revision = '5a2b8c1d9e40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_actors_gender_age', 'actors',
+                    ['gender', 'age', 'id'], unique=False)
+    op.create_index('ix_actors_age', 'actors', ['age', 'id'], unique=False)
+    op.create_index('ix_actors_name', 'actors', ['name', 'id'], unique=False)
+    op.create_index('ix_movies_release_date', 'movies',
+                    ['release_date', 'id'], unique=False)
+    op.create_index('ix_movies_title', 'movies', ['title', 'id'],
+                    unique=False)
+    op.create_index('ix_movies_title_prefix', 'movies', ['title'],
+                    unique=False,
+                    postgresql_ops={'title': 'varchar_pattern_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_movies_title_prefix', table_name='movies')
+    op.drop_index('ix_movies_title', table_name='movies')
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    op.drop_index('ix_actors_name', table_name='actors')
+    op.drop_index('ix_actors_age', table_name='actors')
+    op.drop_index('ix_actors_gender_age', table_name='actors')
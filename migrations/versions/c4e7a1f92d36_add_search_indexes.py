@@ -0,0 +1,45 @@
+"""add search indexes
+
+Revision ID: c4e7a1f92d36
+Revises: 8d3f6a2b1c57
+Create Date: 2026-10-17 13:41:09.117350
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app.models.search import sqlite_fts_statements
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e7a1f92d36'
+down_revision = '8d3f6a2b1c57'
+branch_labels = None
+depends_on = None
+
+SEARCHED_COLUMNS = [('actors', 'name'), ('movies', 'title')]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_actors_name_trgm', 'actors', ['name'], unique=False,
+                    postgresql_using='gin',
+                    postgresql_ops={'name': 'gin_trgm_ops'})
+    op.create_index('ix_movies_title_trgm', 'movies', ['title'],
+                    unique=False, postgresql_using='gin',
+                    postgresql_ops={'title': 'gin_trgm_ops'})
+    if dialect == 'sqlite':
+        for table, column in SEARCHED_COLUMNS:
+            for statement in sqlite_fts_statements(table, column):
+                op.execute(statement)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        for table, column in SEARCHED_COLUMNS:
+            for statement in sqlite_fts_statements(table, column, drop=True):
+                op.execute(statement)
+    op.drop_index('ix_movies_title_trgm', table_name='movies')
+    op.drop_index('ix_actors_name_trgm', table_name='actors')
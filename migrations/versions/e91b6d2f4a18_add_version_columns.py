@@ -0,0 +1,38 @@
+"""add version columns
+
+Revision ID: e91b6d2f4a18
+Revises: c4e7a1f92d36
+Create Date: 2026-10-17 15:12:48.209334
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app.models.search import sqlite_fts_statements
+
+
+# revision identifiers, used by Alembic.
+revision = 'e91b6d2f4a18'
+down_revision = 'c4e7a1f92d36'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('actors', sa.Column('version', sa.Integer(),
+                                      server_default='1', nullable=False))
+    op.add_column('movies', sa.Column('version', sa.Integer(),
+                                      server_default='1', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('movies') as batch_op:
+        batch_op.drop_column('version')
+    with op.batch_alter_table('actors') as batch_op:
+        batch_op.drop_column('version')
+    if op.get_bind().dialect.name == 'sqlite':
+        # SQLite batch mode copies the tables, which drops their search
+        # triggers
+        for table, column in [('actors', 'name'), ('movies', 'title')]:
+            for statement in sqlite_fts_statements(table, column):
+                op.execute(statement)
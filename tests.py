@@ -1,12 +1,80 @@
 import os
-import unittest
+import sys
 import json
-from flask_sqlalchemy import SQLAlchemy
+import marshal
+import gzip
+import time
+import atexit
+import shutil
+import argparse
+import datetime
+import tempfile
+import threading
+import unittest
+import subprocess
+from unittest import mock
+from flask import Flask
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.orm import scoped_session
 
+from auth0_stub import Auth0Stub
+
+"""
+The suite runs offline. Tokens are signed by a local stand-in for Auth0
+whose keys are published as a JWKS file, and every worker process gets a
+database of its own: a SQLite file, or a schema of TEST_DATABASE_URL when
+it points at Postgres. The app and the tables are created once per worker
+and each test runs in a transaction that is rolled back afterwards.
+
+    python tests.py                all the tests in this process
+    python tests.py --workers 4    the tests split between 4 processes
+    pytest -n 4 tests.py           the same with pytest-xdist
+
+The app reads its settings at import time, so they are set up before it
+is imported.
+"""
 
-from app import create_app
-from app.models.models import Actor, Movie, setup_db, db_drop_and_create_all
-from config import bearer_tokens
+WORKER = (os.environ.get("TEST_WORKER")
+          or os.environ.get("PYTEST_XDIST_WORKER") or "main")
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL", "")
+SCHEMA = f"test_{WORKER}"
+
+TEST_DIR = tempfile.mkdtemp(prefix=f"casting-tests-{WORKER}-")
+atexit.register(shutil.rmtree, TEST_DIR, ignore_errors=True)
+
+# 2048 bit keys take seconds to generate with the pure python rsa package,
+# and the key never leaves the test run
+stub = Auth0Stub(bits=1024)
+stub.write_jwks(os.path.join(TEST_DIR, "jwks.json"))
+stub.install()
+
+# a statement run once per row fails the request instead of being logged
+os.environ.setdefault("DB_N_PLUS_ONE", "raise")
+
+METRICS_TOKEN = "test-metrics-token"
+os.environ["METRICS_TOKEN"] = METRICS_TOKEN
+metrics_auth_header = {"Authorization": f"Bearer {METRICS_TOKEN}"}
+
+if TEST_DATABASE_URL.startswith("postgres"):
+    os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+else:
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(
+        TEST_DIR, "casting.db")
+
+from app import create_app  # noqa: E402
+from app.cache import LRUBackend, response_cache  # noqa: E402
+from app.models.models import (Actor, Movie, db, _counts,  # noqa: E402
+                              BULK_CHUNK_SIZE)
+from app.auth.auth import (AuthError, authorize,  # noqa: E402
+                           compile_permissions)
+from app.auth.cache import (JWKSCache, JWKSUnavailable,  # noqa: E402
+                            TokenCache)
+from app.metrics import Histogram, init_app as init_metrics  # noqa: E402
+from app.models.pool import (engine_options,  # noqa: E402
+                             register_statement_timeout)
+from app.models.queries import (NPlusOneQueries,  # noqa: E402
+                                query_accounting)
+from app.serializer import serializer, orjson  # noqa: E402
 
 """
 Create dict with Authorization key and Bearer
@@ -14,37 +82,123 @@ token as values.
 Later used by test classes as Header
 """
 
-casting_assistant_auth_header = {
-    "Authorization": bearer_tokens["casting_assistant"]
-}
+casting_assistant_auth_header = stub.headers("casting_assistant")
+
+casting_director_auth_header = stub.headers("casting_director")
+
+executive_producer_auth_header = stub.headers("executive_producer")
+
+admin_auth_header = {"Authorization": "Bearer " + stub.token(
+    ["get:actors", "get:movies", "admin:profile"])}
+
+app = None
+
+
+def setUpModule():
+    """Builds the app and the tables once per worker"""
+    global app
+    postgres = TEST_DATABASE_URL.startswith("postgres")
+    if postgres:
+        engine = create_engine(TEST_DATABASE_URL)
+        with engine.begin() as connection:
+            # pg_trgm lives in public where every worker's schema sees it
+            # and none of them drops it, the lock keeps workers starting
+            # together from creating it twice
+            connection.execute(
+                "SELECT pg_advisory_xact_lock(hashtext('casting-tests'))")
+            connection.execute(
+                "CREATE EXTENSION IF NOT EXISTS pg_trgm SCHEMA public")
+            connection.execute(f'DROP SCHEMA IF EXISTS "{SCHEMA}" CASCADE')
+            connection.execute(f'CREATE SCHEMA "{SCHEMA}"')
+        engine.dispose()
+
+    app = create_app()
+
+    @event.listens_for(db.engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        if postgres:
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f'SET search_path TO "{SCHEMA}", public')
+            cursor.close()
+            dbapi_connection.commit()
+        else:
+            # pysqlite opens and commits transactions on its own, which
+            # breaks SAVEPOINT, SQLAlchemy emits BEGIN instead
+            dbapi_connection.isolation_level = None
+
+    @event.listens_for(db.engine, "begin")
+    def begin(connection):
+        if not postgres:
+            connection.execute("BEGIN")
+
+    db.create_all()
+
+
+def tearDownModule():
+    db.session.remove()
+    db.drop_all()
+    db.engine.dispose()
+    if TEST_DATABASE_URL.startswith("postgres"):
+        engine = create_engine(TEST_DATABASE_URL)
+        engine.execute(f'DROP SCHEMA IF EXISTS "{SCHEMA}" CASCADE')
+        engine.dispose()
+
+
+class SavepointSession(scoped_session):
+    """Scoped session of the app joining the transaction of a test through
+    a SAVEPOINT, started again each time the code under test commits or
+    rolls back. Removing the session rolls its SAVEPOINT back, the way
+    closing a session rolls back its transaction.
+    """
+
+    def __init__(self, connection):
+        factory = db.create_session({"bind": connection, "binds": {}})
+
+        @event.listens_for(factory, "after_transaction_end")
+        def restart_savepoint(session, transaction):
+            if (transaction.nested and not transaction._parent.nested
+                    and not session.info.get("removed")):
+                session.begin_nested()
 
-casting_director_auth_header = {
-    "Authorization": bearer_tokens["casting_director"]
-}
+        def create_session():
+            session = factory()
+            session.begin_nested()
+            return session
 
-executive_producer_auth_header = {
-    "Authorization": bearer_tokens["executive_producer"]
-}
+        super().__init__(create_session)
 
+    def remove(self):
+        if self.registry.has():
+            session = self.registry()
+            session.info["removed"] = True
+            session.rollback()
+        super().remove()
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Runs each test in a transaction that is rolled back afterwards, so
+    nothing a test writes is left for the next one
+    """
 
-class CastingTestCase(unittest.TestCase):
     def setUp(self):
-        self.app = create_app()
-        self.client = self.app.test_client
-        self.database_path = os.environ["DATABASE_URL"]
-        setup_db(self.app, self.database_path)
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
+        self.app = app
+        self.client = app.test_client
+        self.db = db
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.app_session = db.session
+        db.session = SavepointSession(self.connection)
+        response_cache.clear()
+        _counts.clear()
 
     def tearDown(self):
-        """Executed after reach test"""
-        pass
+        db.session.remove()
+        db.session = self.app_session
+        self.transaction.rollback()
+        self.connection.close()
+
 
+class CastingTestCase(DatabaseTestCase):
     """
     Tests for checking the endpoints with Executive
     roducer role, this role can access all the endpoints
@@ -55,7 +209,6 @@ class CastingTestCase(unittest.TestCase):
         # Create some data in the db
         actor = Actor(name="xyz", age=32, gender="male")
         actor.insert()
-        id = actor.id
 
         # Hit the GET/actors endpoint
         res = self.client().get("/api/actors",
@@ -68,10 +221,6 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data["count"], 1)
         self.assertIsNotNone(data["actors"])
 
-        # Delete the actor from db
-        actor = Actor.query.filter_by(id=id).one_or_none()
-        actor.delete()
-
     def test_get_actors_failure(self):
         """This tests the endpoint when no actors exist in database"""
         res = self.client().get("/api/actors",
@@ -82,13 +231,449 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data["success"], False)
 
+    def test_get_actors_paginated(self):
+        """This tests paging through GET/actors with limit and after"""
+        actors = [Actor(name="xyz", age=30 + i, gender="male")
+                  for i in range(3)]
+        for actor in actors:
+            actor.insert()
+        ids = [actor.id for actor in actors]
+
+        # First page
+        res = self.client().get("/api/actors?limit=2",
+                                headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a["id"] for a in data["actors"]], ids[:2])
+        self.assertIsNotNone(data["next_cursor"])
+        self.assertEqual(data["count"], 3)
+        cursor = data["next_cursor"]
+
+        # Last page
+        res = self.client().get(
+            f"/api/actors?limit=2&after={cursor}",
+            headers=executive_producer_auth_header,
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a["id"] for a in data["actors"]], ids[2:])
+        self.assertIsNone(data["next_cursor"])
+        # The total is only counted for the first page
+        self.assertNotIn("count", data)
+
+        res = self.client().get(
+            f"/api/actors?limit=2&after={cursor}&with_count=1",
+            headers=executive_producer_auth_header,
+        )
+        self.assertEqual(json.loads(res.data)["count"], 3)
+
+    def test_get_actors_bad_cursor(self):
+        """This tests GET/actors with a malformed cursor"""
+        res = self.client().get("/api/actors?after=notacursor",
+                                headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+
+    def test_export_actors(self):
+        """This tests the GET/actors/export NDJSON stream"""
+        actor = Actor(name="xyz", age=32, gender="male")
+        actor.insert()
+        id = actor.id
+
+        res = self.client().get("/api/actors/export",
+                                headers=executive_producer_auth_header)
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, "application/x-ndjson")
+        self.assertEqual([json.loads(line)["id"] for line in lines], [id])
+
+    def test_count_actors(self):
+        """This tests GET/actors?count_only=1 and HEAD/actors"""
+        actor = Actor(name="xyz", age=32, gender="male")
+        actor.insert()
+
+        res = self.client().get("/api/actors?count_only=1",
+                                headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["count"], 1)
+        self.assertNotIn("actors", data)
+
+        res = self.client().head("/api/actors",
+                                 headers=executive_producer_auth_header)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers["X-Total-Count"], "1")
+
+    def test_get_actors_not_modified(self):
+        """This tests If-None-Match on GET/actors and its invalidation"""
+        actor = Actor(name="xyz", age=32, gender="male")
+        actor.insert()
+
+        res = self.client().get("/api/actors",
+                                headers=executive_producer_auth_header)
+        etag = res.headers["ETag"]
+        headers = dict(executive_producer_auth_header,
+                       **{"If-None-Match": etag})
+
+        # Unchanged list
+        res = self.client().get("/api/actors", headers=headers)
+        self.assertEqual(res.status_code, 304)
+
+        # A new actor created through the api invalidates the response
+        payload = {"name": "abc", "age": 34, "gender": "female"}
+        created = self.client().post("/api/actors", json=payload,
+                                     headers=executive_producer_auth_header)
+        self.assertEqual(created.status_code, 200)
+        res = self.client().get("/api/actors", headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["count"], 2)
+
+    def test_get_actor(self):
+        """This tests GET/actors/id and GET/actors?ids="""
+        actors = [Actor(name="xyz", age=32, gender="male"),
+                  Actor(name="abc", age=25, gender="female")]
+        for actor in actors:
+            actor.insert()
+        ids = [actor.id for actor in actors]
+
+        res = self.client().get(f"/api/actors/{ids[0]}",
+                                headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["actor"], {"id": ids[0], "name": "xyz",
+                                         "age": 32, "gender": "male"})
+
+        # Unchanged actor
+        headers = dict(executive_producer_auth_header,
+                       **{"If-None-Match": res.headers["ETag"]})
+        res = self.client().get(f"/api/actors/{ids[0]}", headers=headers)
+        self.assertEqual(res.status_code, 304)
+
+        # Another field set is another representation
+        res = self.client().get(f"/api/actors/{ids[0]}?fields=name",
+                                headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], headers["If-None-Match"])
+
+        res = self.client().get(f"/api/actors/{ids[1] + 100}",
+                                headers=executive_producer_auth_header)
+        self.assertEqual(res.status_code, 404)
+
+        # Several actors in the requested order
+        res = self.client().get(
+            f"/api/actors?ids={ids[1]},{ids[0]},{ids[1] + 100}",
+            headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a["id"] for a in data["actors"]],
+                         [ids[1], ids[0]])
+        self.assertEqual(data["missing"], [ids[1] + 100])
+
+    @mock.patch("app.routes.sync.SYNC_LAG", 0)
+    def test_sync_actors(self):
+        """This tests GET/actors/sync"""
+        actors = [Actor(name="xyz", age=32, gender="male"),
+                  Actor(name="abc", age=25, gender="female")]
+        for actor in actors:
+            actor.insert()
+        ids = [actor.id for actor in actors]
+
+        # A full sync
+        res = self.client().get("/api/actors/sync",
+                                headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a["id"] for a in data["actors"]], ids)
+        self.assertEqual(data["deleted"], [])
+        cursor = data["next_cursor"]
+
+        # Only the changes made since are returned
+        self.client().patch(f"/api/actors/{ids[0]}", json={"age": 33},
+                            headers=executive_producer_auth_header)
+        self.client().delete(f"/api/actors/{ids[1]}",
+                             headers=executive_producer_auth_header)
+        res = self.client().get(f"/api/actors/sync?since={cursor}",
+                                headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["actors"], [{"id": ids[0], "name": "xyz",
+                                           "age": 33, "gender": "male"}])
+        self.assertEqual(data["deleted"], [ids[1]])
+        self.assertFalse(data["has_more"])
+
+        res = self.client().get(
+            f"/api/actors/sync?since={data['next_cursor']}",
+            headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual((data["actors"], data["deleted"]), ([], []))
+
+    def test_server_timing(self):
+        """This tests the Server-Timing header and the request metrics"""
+        actor = Actor(name="xyz", age=32, gender="male")
+        actor.insert()
+
+        res = self.client().get("/api/actors",
+                                headers=executive_producer_auth_header)
+        self.assertEqual(res.status_code, 200)
+        phases = dict(entry.split(";dur=") for entry in
+                      res.headers["Server-Timing"].split(", "))
+        for name in ("auth", "db", "format", "serialize", "total"):
+            self.assertGreaterEqual(float(phases[name]), 0)
+
+        res = self.client().get("/metrics", headers=metrics_auth_header)
+        metrics = res.data.decode()
+        self.assertIn('http_request_duration_seconds_count{method="GET",'
+                      'route="/api/actors",status="200"}', metrics)
+        self.assertIn('http_request_phase_seconds_count{route="/api/actors",'
+                      'phase="db"}', metrics)
+
+    def test_query_accounting(self):
+        """This tests the query metrics and the slow query log"""
+        actor = Actor(name="xyz", age=32, gender="male")
+        actor.insert()
+
+        with mock.patch.object(query_accounting, "slow", 1e-9), \
+                self.assertLogs("app.models.queries", "WARNING") as logs:
+            res = self.client().get(f"/api/actors/{actor.id}",
+                                    headers=executive_producer_auth_header)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("Slow query on /api/actors/<int:id>", logs.output[0])
+
+        metrics = self.client().get(
+            "/metrics", headers=metrics_auth_header).data.decode()
+        self.assertIn('db_queries_per_request_count{route='
+                      '"/api/actors/<int:id>"}', metrics)
+        self.assertIn('db_slow_queries_total{route='
+                      '"/api/actors/<int:id>"}', metrics)
+
+    def test_n_plus_one_detection(self):
+        """The same statement run once per row fails the request"""
+        with self.app.test_request_context("/api/actors"):
+            query_accounting.start()
+            for id in range(query_accounting.threshold):
+                db.session.execute(
+                    select([Actor.name]).where(Actor.id == id)).first()
+            with self.assertRaises(NPlusOneQueries):
+                db.session.execute(
+                    select([Actor.name]).where(Actor.id == 0)).first()
+
+    def test_profile_request(self):
+        """This tests profiling a request with the X-Profile header"""
+        actor = Actor(name="xyz", age=32, gender="male")
+        actor.insert()
+
+        # The header needs the admin:profile permission
+        headers = dict(executive_producer_auth_header, **{"X-Profile": "1"})
+        res = self.client().get("/api/actors", headers=headers)
+        self.assertEqual(res.status_code, 401)
+
+        headers = dict(admin_auth_header, **{"X-Profile": "1"})
+        res = self.client().get("/api/actors", headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)["count"], 1)
+        id = res.headers["X-Profile-Id"]
+
+        res = self.client().get("/api/admin/profiles",
+                                headers=admin_auth_header)
+        self.assertEqual(json.loads(res.data)["profiles"][0]["id"], id)
+
+        res = self.client().get(f"/api/admin/profiles/{id}?sort=tottime",
+                                headers=admin_auth_header)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("function calls", res.data.decode())
+
+        res = self.client().get(f"/api/admin/profiles/{id}?format=prof",
+                                headers=admin_auth_header)
+        self.assertIsInstance(marshal.loads(res.data), dict)
+
+        res = self.client().get("/api/admin/profiles/unknown",
+                                headers=admin_auth_header)
+        self.assertEqual(res.status_code, 404)
+
+    def test_memory_snapshots(self):
+        """This tests the tracemalloc snapshots and their diffs"""
+        res = self.client().post("/api/admin/memory/snapshots",
+                                 headers=casting_assistant_auth_header)
+        self.assertEqual(res.status_code, 401)
+
+        res = self.client().post("/api/admin/memory/snapshots",
+                                 headers=admin_auth_header)
+        self.assertEqual(res.status_code, 200)
+        first = json.loads(res.data)["snapshot"]
+        data = [bytearray(1024) for _ in range(100)]
+        res = self.client().post("/api/admin/memory/snapshots?limit=5",
+                                 headers=admin_auth_header)
+        second = json.loads(res.data)["snapshot"]
+
+        res = self.client().get(
+            f"/api/admin/memory/snapshots/{second}?compare={first}",
+            headers=admin_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["traced_memory"]["tracing"])
+        self.assertIn("size_diff", data["statistics"][0])
+
+        res = self.client().delete("/api/admin/memory/snapshots",
+                                   headers=admin_auth_header)
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get(f"/api/admin/memory/snapshots/{first}",
+                                headers=admin_auth_header)
+        self.assertEqual(res.status_code, 404)
+
+    def test_get_actors_gzip(self):
+        """This tests the compression of GET/actors responses"""
+        actors = [Actor(name=f"actor {i}", age=30, gender="male")
+                  for i in range(20)]
+        for actor in actors:
+            actor.insert()
+
+        headers = dict(executive_producer_auth_header,
+                       **{"Accept-Encoding": "gzip"})
+        res = self.client().get("/api/actors", headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", res.headers["Vary"])
+        self.assertTrue(res.headers["ETag"].startswith("W/"))
+        data = json.loads(gzip.decompress(res.data))
+        self.assertEqual(data["count"], 20)
+
+        # Without Accept-Encoding the response is sent as it is
+        res = self.client().get("/api/actors",
+                                headers=executive_producer_auth_header)
+        self.assertNotIn("Content-Encoding", res.headers)
+        self.assertEqual(json.loads(res.data), data)
+
+    def test_post_actors_gzip(self):
+        """This tests gzip encoded request bodies"""
+        payload = {"name": "abc", "age": 34, "gender": "female"}
+        headers = dict(executive_producer_auth_header,
+                       **{"Content-Encoding": "gzip"})
+        res = self.client().post(
+            "/api/actors", headers=headers,
+            data=gzip.compress(json.dumps(payload).encode()),
+            content_type="application/json")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Actor.query.get(data["created"]).name, "abc")
+
+        # Bodies growing too large once decompressed are rejected
+        body = {"name": "a" * 20 * 1024 * 1024, "age": 34, "gender": "male"}
+        res = self.client().post(
+            "/api/actors", headers=headers,
+            data=gzip.compress(json.dumps(body).encode()),
+            content_type="application/json")
+        self.assertEqual(res.status_code, 413)
+        self.assertEqual(Actor.query.count(), 1)
+
+    def test_get_actors_filtered_and_sorted(self):
+        """This tests the filters and sort of GET/actors"""
+        actors = [Actor(name="xyz", age=40, gender="male"),
+                  Actor(name="abc", age=25, gender="female"),
+                  Actor(name="def", age=30, gender="male")]
+        for actor in actors:
+            actor.insert()
+
+        res = self.client().get(
+            "/api/actors?gender=male&min_age=30&sort=-age&limit=1",
+            headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["count"], 2)
+        self.assertEqual([a["age"] for a in data["actors"]], [40])
+
+        # The cursor continues in the same order
+        res = self.client().get(
+            "/api/actors?gender=male&min_age=30&sort=-age&limit=1"
+            f"&after={data['next_cursor']}",
+            headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual([a["age"] for a in data["actors"]], [30])
+        self.assertIsNone(data["next_cursor"])
+
+        # Unknown sort keys are rejected
+        res = self.client().get("/api/actors?sort=gender",
+                                headers=executive_producer_auth_header)
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_movies_filtered(self):
+        """This tests the title and release date filters of GET/movies"""
+        date = datetime.datetime
+        movies = [Movie(title="xyz", release_date=date(2020, 1, 1)),
+                  Movie(title="xya", release_date=date(2021, 1, 1)),
+                  Movie(title="abc", release_date=date(2021, 6, 1))]
+        for movie in movies:
+            movie.insert()
+
+        res = self.client().get(
+            "/api/movies?title_prefix=xy&released_after=01/06/2020",
+            headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([m["title"] for m in data["movies"]], ["xya"])
+
+    def test_search(self):
+        """This tests GET/search over actor names and movie titles"""
+        actor = Actor(name="tom hanks", age=64, gender="male")
+        actor.insert()
+        actor_id = actor.id
+        movie = Movie(title="the tomb",
+                      release_date=datetime.datetime(2020, 1, 1))
+        movie.insert()
+        movie_id = movie.id
+
+        res = self.client().get("/api/search?q=tom",
+                                headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a["id"] for a in data["actors"]], [actor_id])
+        self.assertEqual([m["id"] for m in data["movies"]], [movie_id])
+
+        # The index follows updates made through the models
+        actor = Actor.query.filter_by(id=actor_id).one_or_none()
+        actor.name = "meryl streep"
+        actor.update()
+        res = self.client().get("/api/search?q=tom",
+                                headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(data["actors"], [])
+
+    def test_search_failure(self):
+        """This tests GET/search without a query"""
+        res = self.client().get("/api/search",
+                                headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+
+    def test_get_actors_fields(self):
+        """This tests GET/actors?fields= projections"""
+        actor = Actor(name="xyz", age=32, gender="male")
+        actor.insert()
+        actor_id = actor.id
+
+        res = self.client().get("/api/actors?fields=id,name",
+                                headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["actors"], [{"id": actor_id, "name": "xyz"}])
+
+        # Unknown fields are rejected
+        res = self.client().get("/api/actors?fields=id,title",
+                                headers=executive_producer_auth_header)
+        self.assertEqual(res.status_code, 400)
+
     def test_get_movies(self):
         """This tests the GET/movies endpoint"""
 
         # Crete a row in movies table
-        movie = Movie(title="xyz", release_date="26/11/2021")
+        movie = Movie(title="xyz",
+                      release_date=datetime.datetime(2021, 11, 26))
         movie.insert()
-        id = movie.id
 
         # Hit GET/movies endpoint
         res = self.client().get("/api/movies",
@@ -101,10 +686,6 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data["count"], 1)
         self.assertIsNotNone(data["movies"])
 
-        # Delete the movies object
-        movie = Movie.query.filter_by(id=id).one_or_none()
-        movie.delete()
-
     def test_get_movies_failure(self):
         '''Tests the GET/movies when there is no data in db'''
 
@@ -139,6 +720,55 @@ class CastingTestCase(unittest.TestCase):
         actor = Actor.query.filter_by(id=id).one_or_none()
         self.assertIsNone(actor)
 
+    def statements_of(self, method, path, headers):
+        """Runs a request and returns it along with the SQL statements it
+        ran, on one line each and without the savepoints of the test
+        transaction
+        """
+        statements = []
+
+        def capture(conn, cursor, statement, *args):
+            if not statement.startswith(("SAVEPOINT", "RELEASE",
+                                         "ROLLBACK")):
+                statements.append(" ".join(statement.split()))
+
+        event.listen(db.engine, "before_cursor_execute", capture)
+        try:
+            res = self.client().open(path, method=method, headers=headers)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", capture)
+        return res, statements
+
+    def test_delete_actors_single_statement(self):
+        """Tests that DELETE/actors/id doesn't read the row first"""
+        actor = Actor(name="xyz", age=29, gender="male")
+        actor.insert()
+
+        res, statements = self.statements_of(
+            "DELETE", f"/api/actors/{actor.id}",
+            executive_producer_auth_header)
+        self.assertEqual(res.status_code, 200)
+        if db.engine.dialect.name == "postgresql":
+            # the tombstone is written by the DELETE itself
+            self.assertEqual(len(statements), 1)
+            self.assertTrue(statements[0].startswith(
+                "WITH deleted AS (DELETE FROM actors WHERE actors.id = "))
+        else:
+            # SQLite writes the tombstone first
+            self.assertEqual(statements, [
+                "INSERT INTO tombstones (resource, resource_id, deleted_at) "
+                "SELECT ? AS anon_1, actors.id, strftime('%Y-%m-%d "
+                "%H:%M:%f000', 'now') FROM actors WHERE actors.id = ?",
+                "DELETE FROM actors WHERE actors.id = ?",
+            ])
+
+        # A missing row is found by the same statements
+        missing_res, missing_statements = self.statements_of(
+            "DELETE", f"/api/actors/{actor.id}",
+            executive_producer_auth_header)
+        self.assertEqual(missing_res.status_code, 404)
+        self.assertEqual(missing_statements, statements)
+
     def test_delete_actor_failure(self):
         """Tests the endpoint when invalid id is provided"""
 
@@ -158,7 +788,8 @@ class CastingTestCase(unittest.TestCase):
         """Tests the endpoint when movies exist in db"""
 
         # Create a movie resource
-        movie = Movie(title="xyz", release_date="26/11/2021")
+        movie = Movie(title="xyz",
+                      release_date=datetime.datetime(2021, 11, 26))
         movie.insert()
         id = movie.id
 
@@ -207,8 +838,18 @@ class CastingTestCase(unittest.TestCase):
         # Check if the actor persisted in data
         actor = Actor.query.filter_by(id=data["created"]).one_or_none()
         self.assertIsNotNone(actor)
-        # Delete the actor
-        actor.delete()
+
+    def test_post_actors_representation(self):
+        """This tests returning the created actor"""
+        payload = {"name": "XYZ", "age": 34, "gender": "male"}
+        headers = dict(executive_producer_auth_header,
+                       Prefer="return=representation")
+        res = self.client().post("/api/actors", json=payload, headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["actor"], {"id": data["created"], "name": "xyz",
+                                         "age": 34, "gender": "male"})
 
     def test_post_actors_failure(self):
         """This tests the behaviour when post data has bad keys"""
@@ -242,9 +883,6 @@ class CastingTestCase(unittest.TestCase):
         movie = Movie.query.filter_by(id=data["created"]).one_or_none()
         self.assertIsNotNone(movie)
 
-        # Remove the movie from db
-        movie.delete()
-
     def test_post_movies_failure(self):
         """Tests when keys are missing in post request"""
         payload = {"title": "xyz"}
@@ -259,6 +897,104 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 400)
         self.assertEqual(data["success"], False)
 
+    def test_post_actors_bulk(self):
+        """This tests creating several actors in one request"""
+        payload = {"actors": [{"name": "xyz", "age": 34, "gender": "male"},
+                              {"name": "abc", "age": 29, "gender": "female"}]}
+        res = self.client().post("/api/actors/bulk", json=payload,
+                                 headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(len(data["created"]), 2)
+        self.assertEqual([r["id"] for r in data["results"]], data["created"])
+
+        # Check the actors persisted
+        for id in data["created"]:
+            actor = Actor.query.filter_by(id=id).one_or_none()
+            self.assertIsNotNone(actor)
+
+    def test_post_actors_bulk_many(self):
+        """Bulk inserts past the N+1 threshold aren't flagged"""
+        count = query_accounting.threshold * 2
+        payload = {"actors": [{"name": f"actor {i}", "age": 30,
+                               "gender": "male"} for i in range(count)]}
+        res = self.client().post("/api/actors/bulk", json=payload,
+                                 headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data["created"]), count)
+        self.assertEqual(Actor.query.count(), count)
+
+    def test_post_actors_bulk_failure(self):
+        """One invalid item rejects the whole bulk payload"""
+        payload = {"actors": [{"name": "xyz", "age": 34, "gender": "male"},
+                              {"name": "abc", "age": 29}]}
+        res = self.client().post("/api/actors/bulk", json=payload,
+                                 headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertEqual([r["index"] for r in data["results"]], [1])
+        self.assertIsNone(Actor.query.filter_by(name="xyz").one_or_none())
+
+    def test_patch_and_delete_actors_bulk(self):
+        """This tests bulk updates and deletes, including unknown ids"""
+        actor = Actor(name="xyz", age=32, gender="male")
+        actor.insert()
+        id = actor.id
+
+        payload = {"actors": [{"id": id, "age": 24},
+                              {"id": id + 100, "age": 24}]}
+        res = self.client().patch("/api/actors/bulk", json=payload,
+                                  headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["updated"], [id])
+        self.assertEqual(data["results"][1]["error"], 404)
+        self.assertEqual(Actor.query.get(id).age, 24)
+
+        payload = {"ids": [id, id + 100]}
+        res = self.client().delete("/api/actors/bulk", json=payload,
+                                   headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["deleted"], [id])
+        self.assertIsNone(Actor.query.filter_by(id=id).one_or_none())
+
+    @mock.patch.object(query_accounting, "threshold", 1)
+    def test_patch_and_delete_actors_bulk_many(self):
+        """Id lookups split in chunks aren't flagged as N+1 queries"""
+        actor = Actor(name="xyz", age=32, gender="male")
+        actor.insert()
+        # three full chunks of the same lookup
+        ids = [actor.id] + [actor.id + 1 + i
+                            for i in range(BULK_CHUNK_SIZE * 3 - 1)]
+
+        payload = {"actors": [{"id": id, "age": 24} for id in ids]}
+        res = self.client().patch("/api/actors/bulk", json=payload,
+                                  headers=executive_producer_auth_header)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)["updated"], [actor.id])
+
+        res = self.client().delete("/api/actors/bulk", json={"ids": ids},
+                                   headers=executive_producer_auth_header)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)["deleted"], [actor.id])
+
+    def test_casting_assistant_post_actors_bulk(self):
+        """Bulk endpoints need the same permissions as single ones"""
+        payload = {"actors": [{"name": "xyz", "age": 34, "gender": "male"}]}
+        res = self.client().post("/api/actors/bulk", json=payload,
+                                 headers=casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data["success"], False)
+
     def test_actors_patch(self):
         """Tests the behavior when correct patch request is sent"""
         payload = {"age": 24}
@@ -283,8 +1019,67 @@ class CastingTestCase(unittest.TestCase):
         actor = Actor.query.filter_by(id=id).one_or_none()
         self.assertEqual(actor.age, payload["age"])
 
-        # Delete the actor resource
-        actor.delete()
+    def test_actors_patch_if_match(self):
+        """Tests If-Match on the patch endpoint"""
+        actor = Actor(name="xyz", age=32, gender="male")
+        actor.insert()
+        id = actor.id
+
+        res = self.client().patch(f"/api/actors/{id}", json={"age": 24},
+                                  headers=executive_producer_auth_header)
+        self.assertEqual(res.status_code, 200)
+        etag = res.headers["ETag"]
+
+        # A stale version is refused
+        headers = dict(executive_producer_auth_header, **{"If-Match": '"1"'})
+        res = self.client().patch(f"/api/actors/{id}", json={"age": 25},
+                                  headers=headers)
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(Actor.query.get(id).age, 24)
+
+        # The current version is accepted
+        headers = dict(executive_producer_auth_header, **{"If-Match": etag})
+        res = self.client().patch(f"/api/actors/{id}", json={"age": 25},
+                                  headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], etag)
+        actor = Actor.query.get(id)
+        self.assertEqual(actor.age, 25)
+
+    def test_actors_etag_if_match(self):
+        """Tests the ETag of GET/actors/id as an If-Match of a PATCH"""
+        actor = Actor(name="xyz", age=32, gender="male")
+        actor.insert()
+        id = actor.id
+        res = self.client().get(f"/api/actors/{id}?fields=name",
+                                headers=executive_producer_auth_header)
+        etag = res.headers["ETag"]
+
+        headers = dict(executive_producer_auth_header, **{"If-Match": etag})
+        res = self.client().patch(f"/api/actors/{id}", json={"age": 24},
+                                  headers=headers)
+        self.assertEqual(res.status_code, 200)
+        res = self.client().patch(f"/api/actors/{id}", json={"age": 25},
+                                  headers=headers)
+        self.assertEqual(res.status_code, 412)
+
+        # The ETag of a deleted row doesn't match a new row with its id,
+        # which SQLite hands out again
+        res = self.client().get(f"/api/actors/{id}",
+                                headers=executive_producer_auth_header)
+        etag = res.headers["ETag"]
+        self.client().delete(f"/api/actors/{id}",
+                             headers=executive_producer_auth_header)
+        time.sleep(0.002)
+        res = self.client().post("/api/actors", json={
+            "name": "xyz", "age": 25, "gender": "male"},
+            headers=executive_producer_auth_header)
+        new_id = json.loads(res.data)["created"]
+        self.client().patch(f"/api/actors/{new_id}", json={"age": 24},
+                            headers=executive_producer_auth_header)
+        res = self.client().get(f"/api/actors/{new_id}",
+                                headers=executive_producer_auth_header)
+        self.assertNotEqual(res.headers["ETag"], etag)
 
     def test_actors_patch_failure(self):
         """Tests the behaviour when wrong id is sent"""
@@ -310,9 +1105,6 @@ class CastingTestCase(unittest.TestCase):
         actor = Actor.query.filter_by(id=id).one_or_none()
         self.assertNotEqual(actor.age, payload["age"])
 
-        # Delete the actor resource
-        actor.delete()
-
     def test_actors_patch_failure_wrong_payload(self):
         """Tests if keys in the patch request are invalid"""
 
@@ -334,15 +1126,13 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 400)
         self.assertEqual(data["success"], False)
 
-        # Delete the actor resource
-        actor.delete()
-
     def test_movies_patch(self):
         """Tests the behavior when correct patch request is sent"""
         payload = {"title": "xyz"}
 
         # Create a Movie resource in db
-        movie = Movie(title="abc", release_date="26/11/2021")
+        movie = Movie(title="abc",
+                      release_date=datetime.datetime(2021, 11, 26))
         movie.insert()
         id = movie.id
 
@@ -361,14 +1151,12 @@ class CastingTestCase(unittest.TestCase):
         movie = Movie.query.filter_by(id=id).one_or_none()
         self.assertEqual(movie.title, payload["title"])
 
-        # Delete the movie resource
-        movie.delete()
-
     def test_movies_patch_failure(self):
         """Tests the behaviour when wrong id is sent"""
         payload = {"title": "xyz"}
         # Create an movie resource in db
-        movie = Movie(title="abc", release_date="26/11/2021")
+        movie = Movie(title="abc",
+                      release_date=datetime.datetime(2021, 11, 26))
         movie.insert()
         id = movie.id
 
@@ -388,16 +1176,14 @@ class CastingTestCase(unittest.TestCase):
         movie = Movie.query.filter_by(id=id).one_or_none()
         self.assertNotEqual(movie.title, payload["title"])
 
-        # Delete the actor resource
-        movie.delete()
-
     def test_movies_patch_failure_wrong_payload(self):
         """Tests if keys in the patch request are invalid"""
 
         payload = {"age": 20}
 
         # Create an actor resource in db
-        movie = Movie(title="xyz", release_date="26/11/2021")
+        movie = Movie(title="xyz",
+                      release_date=datetime.datetime(2021, 11, 26))
         movie.insert()
         id = movie.id
 
@@ -412,9 +1198,6 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 400)
         self.assertEqual(data["success"], False)
 
-        # Delete the actor resource
-        movie.delete()
-
     """
     Tests for Casting Director, this
     role doesn't have access to /POST/movies
@@ -425,7 +1208,6 @@ class CastingTestCase(unittest.TestCase):
         # Create some data in the db
         actor = Actor(name="xyz", age=32, gender="male")
         actor.insert()
-        id = actor.id
 
         # Hit the GET/actors endpoint
         res = self.client().get("/api/actors",
@@ -438,10 +1220,6 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data["count"], 1)
         self.assertIsNotNone(data["actors"])
 
-        # Delete the actor from db
-        actor = Actor.query.filter_by(id=id).one_or_none()
-        actor.delete()
-
     def test_casting_director_post_movies(self):
         """This tests the response when correct data is sent"""
         payload = {"title": "xyz", "release_date": "26/11/2021"}
@@ -465,7 +1243,6 @@ class CastingTestCase(unittest.TestCase):
         # Create some data in the db
         actor = Actor(name="xyz", age=32, gender="male")
         actor.insert()
-        id = actor.id
 
         # Hit the GET/actors endpoint
         res = self.client().get("/api/actors",
@@ -478,10 +1255,6 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data["count"], 1)
         self.assertIsNotNone(data["actors"])
 
-        # Delete the actor from db
-        actor = Actor.query.filter_by(id=id).one_or_none()
-        actor.delete()
-
     def test_casting_assistant_post_movies(self):
         """This tests the response when correct data is sent"""
         payload = {"title": "xyz", "release_date": "26/11/2021"}
@@ -497,5 +1270,353 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data["success"], False)
 
 
+class JWKSCacheTestCase(unittest.TestCase):
+    """Tests for the in-process JWKS cache, run against a local JWKS file"""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".json")
+        os.close(handle)
+        self.url = f"file://{self.path}"
+        self.write_keys("k1")
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def write_keys(self, *kids):
+        keys = [{"kid": kid, "kty": "RSA", "use": "sig", "n": "n", "e": "e"}
+                for kid in kids]
+        with open(self.path, "w") as f:
+            json.dump({"keys": keys}, f)
+
+    def test_keys_are_served_from_memory(self):
+        """The JWKS is only read once while it is fresh"""
+        cache = JWKSCache(self.url, ttl=3600)
+        self.assertEqual(cache.get_key("k1")["kid"], "k1")
+
+        os.remove(self.path)
+        self.assertEqual(cache.get_key("k1")["kid"], "k1")
+
+    def test_unknown_kid_forces_refresh(self):
+        """A rotated key is picked up without waiting for the ttl"""
+        cache = JWKSCache(self.url, ttl=3600, min_refresh_interval=0)
+        self.assertIsNone(cache.get_key("k2"))
+
+        self.write_keys("k1", "k2")
+        self.assertEqual(cache.get_key("k2")["kid"], "k2")
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        """Unknown kids don't trigger a fetch on every call"""
+        cache = JWKSCache(self.url, ttl=3600, min_refresh_interval=3600)
+        self.assertIsNone(cache.get_key("k2"))
+
+        self.write_keys("k1", "k2")
+        self.assertIsNone(cache.get_key("k2"))
+
+    def test_stale_keys_are_served_on_error(self):
+        """Expired keys are still used while the JWKS can't be fetched"""
+        cache = JWKSCache(self.url, ttl=0, stale_ttl=3600,
+                          min_refresh_interval=0)
+        self.assertEqual(cache.get_key("k1")["kid"], "k1")
+
+        os.remove(self.path)
+        self.assertEqual(cache.get_key("k1")["kid"], "k1")
+
+    def test_unavailable_without_cached_keys(self):
+        """A failed first fetch is reported as JWKSUnavailable"""
+        os.remove(self.path)
+        cache = JWKSCache(self.url)
+        with self.assertRaises(JWKSUnavailable):
+            cache.get_key("k1")
+
+    def test_concurrent_requests_share_one_fetch(self):
+        """Requests waiting on a fetch use its result, at cold start and
+        once the keys can't be served anymore
+        """
+        cache = JWKSCache(self.url, ttl=3600, min_refresh_interval=0)
+        fetch = cache._fetch
+        fetches = []
+
+        def slow_fetch():
+            fetches.append(1)
+            time.sleep(0.05)
+            return fetch()
+
+        cache._fetch = slow_fetch
+        for expired_at in (None, time.monotonic() - cache.stale_ttl - 1):
+            cache._fetched_at = expired_at
+            del fetches[:]
+            threads = [threading.Thread(target=cache.get_key, args=("k1",))
+                       for _ in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(fetches), 1)
+
+    def test_expired_keys_are_served_while_refreshing(self):
+        """Past the ttl the cached keys are served without waiting"""
+        cache = JWKSCache(self.url, ttl=60, stale_ttl=3600)
+        self.assertEqual(cache.get_key("k1")["kid"], "k1")
+        refreshed = threading.Event()
+        release = threading.Event()
+
+        def blocked_fetch():
+            refreshed.set()
+            release.wait(5)
+            return {"k1": {"kid": "k1"}}
+
+        cache._fetch = blocked_fetch
+        cache._fetched_at = time.monotonic() - 120
+        cache._last_attempt = cache._fetched_at
+        self.assertEqual(cache.get_key("k1")["kid"], "k1")
+        self.assertTrue(refreshed.wait(5))
+        release.set()
+        cache._background.join()
+        self.assertLess(cache._age(time.monotonic()), 60)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """Tests for the verified-token cache"""
+
+    def test_hits_and_misses_are_counted(self):
+        cache = TokenCache(maxsize=2)
+        self.assertIsNone(cache.get("token"))
+        cache.put("token", {"sub": "xyz"})
+        self.assertEqual(cache.get("token"), {"sub": "xyz"})
+
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_expired_tokens_are_evicted(self):
+        cache = TokenCache(maxsize=2)
+        cache.put("token", {"sub": "xyz"}, expires_at=time.time() - 1)
+        self.assertIsNone(cache.get("token"))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_least_recently_used_token_is_evicted(self):
+        cache = TokenCache(maxsize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+
+class LRUBackendTestCase(unittest.TestCase):
+    """Tests for the in-process response cache backend"""
+
+    def test_least_recently_used_entry_is_evicted(self):
+        backend = LRUBackend(maxsize=2, ttl=60)
+        backend.set("a", 1)
+        backend.set("b", 2)
+        backend.get("a")
+        backend.set("c", 3)
+
+        self.assertIsNone(backend.get("b"))
+        self.assertEqual(backend.get("a"), 1)
+
+    def test_expired_entries_are_dropped(self):
+        backend = LRUBackend(maxsize=2, ttl=0)
+        backend.set("a", 1)
+        self.assertIsNone(backend.get("a"))
+
+    def test_bump_changes_only_its_namespace(self):
+        backend = LRUBackend()
+        backend.bump("actors")
+        self.assertEqual(backend.generation("actors"), 1)
+        self.assertEqual(backend.generation("movies"), 0)
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Tests for the Prometheus metrics and the engine settings"""
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram("test_seconds", "Test", buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        samples = list(histogram.samples())
+
+        self.assertIn('test_seconds_bucket{le="0.1"} 1', samples)
+        self.assertIn('test_seconds_bucket{le="1.0"} 2', samples)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3', samples)
+        self.assertIn("test_seconds_count 3", samples)
+
+    def test_metrics_need_the_token(self):
+        app = Flask(__name__)
+        with mock.patch.dict(os.environ, {"METRICS_TOKEN": "secret"}):
+            init_metrics(app)
+        client = app.test_client()
+
+        self.assertEqual(client.get("/metrics").status_code, 401)
+        res = client.get("/metrics",
+                         headers={"Authorization": "Bearer wrong"})
+        self.assertEqual(res.status_code, 401)
+
+    def test_metrics_off_without_token(self):
+        app = Flask(__name__)
+        with mock.patch.dict(os.environ, {"METRICS_TOKEN": ""}):
+            init_metrics(app)
+
+        self.assertEqual(app.test_client().get("/metrics").status_code, 404)
+
+    def test_engine_options_from_environment(self):
+        env = {"DB_POOL_SIZE": "20", "DB_STATEMENT_TIMEOUT": "5000"}
+        with mock.patch.dict(os.environ, env):
+            options = engine_options("postgresql://localhost/casting")
+
+        self.assertEqual(options["pool_size"], 20)
+        # pgbouncer refuses the options startup parameter
+        self.assertNotIn("connect_args", options)
+
+    def test_statement_timeout_set_on_connect(self):
+        engine = create_engine("sqlite://")
+        env = {"DB_STATEMENT_TIMEOUT": "5000"}
+        with mock.patch.dict(os.environ, env), \
+                mock.patch.object(engine.dialect, "name", "postgresql"):
+            register_statement_timeout(engine)
+        connection = mock.Mock()
+        engine.pool.dispatch.connect(connection, None)
+
+        connection.cursor().execute.assert_called_once_with(
+            "SET statement_timeout = 5000")
+        connection.commit.assert_called_once_with()
+
+    def test_no_statement_timeout_on_sqlite(self):
+        engine = create_engine("sqlite://")
+        with mock.patch.dict(os.environ, {"DB_STATEMENT_TIMEOUT": "5000"}):
+            register_statement_timeout(engine)
+
+        self.assertFalse(engine.pool.dispatch.connect)
+
+    def test_nullpool_mode(self):
+        with mock.patch.dict(os.environ, {"DB_NULLPOOL": "1"}):
+            options = engine_options("postgresql://localhost/casting")
+
+        self.assertNotIn("pool_size", options)
+        self.assertEqual(options["poolclass"].__name__, "NullPool")
+
+
+class SerializerTestCase(unittest.TestCase):
+    """The fast encoder has to write the same bytes as flask.jsonify"""
+
+    payloads = [
+        {"success": True, "count": 2, "next_cursor": None,
+         "actors": [{"id": 1, "name": "xyz", "age": 32, "gender": "male"}]},
+        {"movies": [{"id": 1, "title": "abc",
+                     "release_date": datetime.datetime(2021, 11, 26)}]},
+        {"b": [1.5, 0.1, -2.25], "a": {"z": 1, "y": [True, False]}},
+        {"name": "d\u00e9j\u00e0 vu \u2028", "ctrl": "\x00\t\n\x7f\"/"},
+        {"score": 1e-07, "big": 1e16, "huge": 2 ** 70},
+        {1: "int key"},
+        [],
+    ]
+
+    def setUp(self):
+        self.app = app
+
+    @unittest.skipIf(orjson is None, "orjson is not installed")
+    def test_jsonify_is_byte_compatible(self):
+        from flask import jsonify as flask_jsonify
+
+        with self.app.test_request_context(), \
+                mock.patch.object(serializer, "fast", True):
+            # the list payloads don't need the stdlib encoder
+            self.assertIsNotNone(serializer._fast_dumps(self.payloads[0]))
+            self.assertIsNotNone(serializer._fast_dumps(self.payloads[1]))
+            for payload in self.payloads:
+                expected = flask_jsonify(payload)
+                response = serializer.jsonify(payload)
+                self.assertEqual(response.get_data(), expected.get_data())
+                self.assertEqual(response.mimetype, expected.mimetype)
+
+    def test_dumps_matches_flask_dumps(self):
+        from flask import json as flask_json
+
+        with self.app.test_request_context():
+            for payload in self.payloads:
+                expected = flask_json.dumps(payload, separators=(",", ":"))
+                self.assertEqual(serializer.dumps(payload), expected.encode())
+
+
+class PermissionsTestCase(unittest.TestCase):
+    """Tests for compiled permission requirements"""
+
+    granted = frozenset(["get:actors", "get:movies"])
+
+    def test_all_of(self):
+        required = compile_permissions(["get:actors", "get:movies"])
+        self.assertTrue(authorize(required, self.granted))
+
+        required = compile_permissions(["get:actors", "post:actors"])
+        with self.assertRaises(AuthError) as ctx:
+            authorize(required, self.granted)
+        self.assertEqual(ctx.exception.status_code, 401)
+
+    def test_any_of(self):
+        required = compile_permissions(any_of=["post:actors", "get:movies"])
+        self.assertTrue(authorize(required, self.granted))
+
+        required = compile_permissions(any_of=["post:actors", "post:movies"])
+        with self.assertRaises(AuthError) as ctx:
+            authorize(required, self.granted)
+        self.assertEqual(ctx.exception.status_code, 401)
+
+    def test_missing_permissions_claim(self):
+        required = compile_permissions("get:actors")
+        with self.assertRaises(AuthError) as ctx:
+            authorize(required, None)
+        self.assertEqual(ctx.exception.status_code, 400)
+
+
+def _test_ids(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            yield from _test_ids(test)
+        else:
+            yield test.id().split(".", 1)[1]
+
+
+def run_parallel(workers, argv):
+    """Splits the tests selected by argv between worker processes, each
+    with its own database, and returns the worst exit status
+    """
+    names = [arg for arg in argv if not arg.startswith("-")]
+    options = [arg for arg in argv if arg.startswith("-")]
+    loader = unittest.defaultTestLoader
+    module = sys.modules[__name__]
+    if names:
+        suite = loader.loadTestsFromNames(names, module)
+    else:
+        suite = loader.loadTestsFromModule(module)
+    tests = list(_test_ids(suite))
+
+    processes = []
+    for worker in range(min(workers, len(tests))):
+        env = dict(os.environ, TEST_WORKER=f"w{worker}")
+        processes.append(subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), *options,
+             *tests[worker::workers]],
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT))
+    status = 0
+    for worker, process in enumerate(processes):
+        output, _ = process.communicate()
+        print(f"--- worker {worker}")
+        print(output.decode(), end="")
+        status = max(status, process.returncode)
+    return status
+
+
 if __name__ == "__main__":
-    unittest.main()
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--workers", type=int, default=1)
+    args, argv = parser.parse_known_args()
+    if args.workers > 1:
+        sys.exit(run_parallel(args.workers, argv))
+    unittest.main(argv=sys.argv[:1] + argv)